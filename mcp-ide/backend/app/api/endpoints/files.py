@@ -1,9 +1,12 @@
+import logging
 from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel
 from typing import Optional, List
 from app.services.file_service import file_service
+from app.services.rag_service import rag_service
 
 router = APIRouter()
+logger = logging.getLogger(__name__)
 
 # ==================== REQUEST MODELS ====================
 
@@ -93,15 +96,14 @@ async def get_file(file_id: str):
 @router.patch("/files/{file_id}")
 async def update_file(file_id: str, request: UpdateFileRequest):
     """Update file content and auto-generate embedding"""
-    print(f"📝 Updating file: {file_id}")
-    print(f"   Content length: {len(request.content)}")
+    logger.debug("📝 Updating file: %s (%d chars)", file_id, len(request.content))
     
     success = await file_service.update_file(file_id, request.content)
     
     if not success:
         raise HTTPException(status_code=500, detail="Failed to update file")
     
-    print(f"✅ File updated successfully: {file_id}")
+    logger.debug("✅ File updated successfully: %s", file_id)
     return {"status": "updated", "file_id": file_id}
 
 @router.delete("/files/{file_id}")
@@ -112,6 +114,9 @@ async def delete_file(file_id: str):
     if not success:
         raise HTTPException(status_code=500, detail="Failed to delete file")
     
+    # The file's embeddings were deleted with it
+    rag_service.clear_search_caches()
+    
     return {"status": "deleted", "file_id": file_id}
 
 @router.post("/files/{file_id}/activate")
@@ -127,7 +132,8 @@ async def activate_file(file_id: str, project_id: str):
 # ==================== FILE HISTORY ====================
 
 @router.get("/files/{file_id}/history")
-async def get_file_history(file_id: str, limit: int = 10):
-    """Get file version history"""
-    history = await file_service.get_file_history(file_id, limit)
-    return {"history": history}
+async def get_file_history(file_id: str, limit: int = 10, before: Optional[str] = None):
+    """Get file version history (pass next_cursor as before for older versions)"""
+    history = await file_service.get_file_history(file_id, limit, before)
+    next_cursor = history[-1]['created_at'] if len(history) == limit else None
+    return {"history": history, "next_cursor": next_cursor}
@@ -1,4 +1,7 @@
+import asyncio
+import orjson
 from fastapi import APIRouter, HTTPException
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from typing import Optional
 from app.services.terminal_service import terminal_service
@@ -34,7 +37,7 @@ async def create_terminal(request: CreateTerminalRequest):
         if not f.get('is_folder', False):
             files_dict[f['path']] = f['content']
     
-    terminal_service.sync_files_to_workspace(session_id, files_dict)
+    await terminal_service.sync_files_to_workspace(session_id, files_dict)
     
     return {
         "session_id": session_id,
@@ -47,6 +50,37 @@ async def execute_command(session_id: str, request: ExecuteCommandRequest):
     result = await terminal_service.execute_command(session_id, request.command)
     return result
 
+@router.post("/{session_id}/execute/stream")
+async def execute_command_stream(session_id: str, request: ExecuteCommandRequest):
+    """
+    Execute a command, streaming its output as it is produced
+    Newline-delimited JSON: {"stream", "data"} chunks, then {"result"}
+    """
+    queue: asyncio.Queue = asyncio.Queue()
+    
+    async def run():
+        try:
+            result = await terminal_service.execute_command(
+                session_id,
+                request.command,
+                on_chunk=lambda stream, data: queue.put_nowait({"stream": stream, "data": data})
+            )
+            queue.put_nowait({"result": result})
+        finally:
+            queue.put_nowait(None)
+    
+    task = asyncio.create_task(run())
+    
+    async def events():
+        try:
+            while (event := await queue.get()) is not None:
+                yield orjson.dumps(event) + b"\n"
+        finally:
+            # Client went away: stop the command
+            task.cancel()
+    
+    return StreamingResponse(events(), media_type="application/x-ndjson")
+
 @router.get("/{session_id}/history")
 async def get_history(session_id: str):
     """Get command history"""
@@ -78,23 +112,23 @@ async def npm_run(session_id: str, request: NpmRunRequest):
 @router.post("/{session_id}/init/node")
 async def init_node_project(session_id: str):
     """Initialize a Node.js project"""
-    result = await terminal_service.execute_command(session_id, "npm init -y")
+    result = await terminal_service.run(session_id, ["npm", "init", "-y"])
     return result
 
 @router.post("/{session_id}/init/react")
 async def init_react_project(session_id: str, project_name: str = "my-app"):
     """Initialize a React project"""
-    result = await terminal_service.execute_command(
+    result = await terminal_service.run(
         session_id,
-        f"npx create-react-app {project_name}"
+        ["npx", "create-react-app", project_name]
     )
     return result
 
 @router.post("/{session_id}/init/vite")
 async def init_vite_project(session_id: str, project_name: str = "my-app"):
     """Initialize a Vite project"""
-    result = await terminal_service.execute_command(
+    result = await terminal_service.run(
         session_id,
-        f"npm create vite@latest {project_name} -- --template react"
+        ["npm", "create", "vite@latest", project_name, "--", "--template", "react"]
     )
     return result
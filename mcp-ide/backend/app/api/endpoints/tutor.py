@@ -1,21 +1,131 @@
-from fastapi import APIRouter, HTTPException
+import asyncio
+import hashlib
+from fastapi import APIRouter, BackgroundTasks, HTTPException
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
 from app.models.schemas import ContextPayload, TutorResponse
 from app.services.tutor_agent import tutor_agent
 from app.services.supabase_service import supabase_service
 from app.services.rag_service import rag_service
+from app.services.embedding_service import embedding_service
 from pydantic import BaseModel
 
 router = APIRouter()
 
+# Appended to a streamed answer that broke off part way
+INTERRUPTED_NOTE = "\n\n[Answer interrupted]"
+
+# User-message saves in flight (the event loop only keeps weak references)
+_pending_saves = set()
+
 class AskTutorRequest(BaseModel):
     editor_state: dict
     user_question: str
-    model_type: str = "ollama"  # "ollama" or "gemini"
+    model_type: str = "ollama"  # "ollama", "gemini" or "anthropic"
     session_id: str = ""  # optional session tracking
     project_id: str = ""  # for RAG context
 
+def _semantic_cache_workspace(request: AskTutorRequest, editor_state, rag_context: str) -> str:
+    """Namespace for cached answers: project, model, the exact editor state, retrieved context and last run"""
+    # EditorState does not keep last_execution, so read it from the raw payload
+    last_execution = request.editor_state.get('last_execution') or {}
+    state = "\0".join([
+        editor_state.file_path,
+        editor_state.full_code,
+        editor_state.selected_text,
+        "\n".join(editor_state.errors),
+        rag_context,
+        str(last_execution.get('output') or ""),
+        str(last_execution.get('error') or "")
+    ])
+    state_hash = hashlib.sha256(state.encode()).hexdigest()[:32]
+    return f"{request.project_id or '-'}:{request.model_type}:{state_hash}"
+
+async def _lookup_cached_answer(request: AskTutorRequest, editor_state, rag_context: str):
+    """
+    Look up a cached answer for a near-duplicate question about the same editor state,
+    retrieved context and last execution result
+    
+    Returns:
+        (workspace, question_embedding, cached response dict or None)
+    """
+    workspace = _semantic_cache_workspace(request, editor_state, rag_context)
+    question_embedding = None
+    cached = None
+    if supabase_service.is_available():
+        question_embedding = await asyncio.get_running_loop().run_in_executor(
+            embedding_service.executor,
+            embedding_service.generate_query_embedding,
+            request.user_question
+        )
+        if question_embedding:
+            cached = await supabase_service.semantic_cache_lookup(question_embedding, workspace)
+    return workspace, question_embedding, cached
+
+async def _get_rag_context(request: AskTutorRequest) -> str:
+    """Get RAG context if project_id provided"""
+    if not request.project_id:
+        return ""
+    return await rag_service.get_rag_context(
+        query=request.user_question,
+        project_id=request.project_id
+    )
+
+def _start_user_message_save(request: AskTutorRequest, editor_state):
+    """
+    Save the user message right away, while context is gathered and the model runs
+    It is written even if the model call fails or a streaming client disconnects
+    """
+    if not (request.session_id and supabase_service.is_available()):
+        return None
+    
+    task = asyncio.create_task(supabase_service.save_message(
+        session_id=request.session_id,
+        role="user",
+        content=request.user_question,
+        code_context=editor_state.full_code,
+        execution_context=getattr(editor_state, 'last_execution', None)
+    ))
+    _pending_saves.add(task)
+    task.add_done_callback(_pending_saves.discard)
+    return task
+
+async def _save_answer(
+    request: AskTutorRequest,
+    editor_state,
+    response: TutorResponse,
+    user_message_saved,
+    question_embedding,
+    workspace: str,
+    cached: bool,
+    complete: bool = True
+):
+    """Save the tutor answer after the user message and cache complete answers (runs after the response)"""
+    # Keep the answer after the question in the session history
+    if user_message_saved:
+        await user_message_saved
+    
+    writes = []
+    if request.session_id and supabase_service.is_available():
+        writes.append(supabase_service.save_message(
+            session_id=request.session_id,
+            role="assistant",
+            content=response.response,
+            code_context=editor_state.full_code
+        ))
+    
+    if complete and not cached and question_embedding and not tutor_agent.is_fallback_response(response):
+        writes.append(supabase_service.semantic_cache_put(
+            question_embedding,
+            response.model_dump(),
+            workspace
+        ))
+    
+    if writes:
+        await asyncio.gather(*writes)
+
 @router.post("/ask", response_model=TutorResponse)
-async def ask_tutor(request: AskTutorRequest):
+async def ask_tutor(request: AskTutorRequest, background_tasks: BackgroundTasks):
     """
     Ask the Shadow Tutor for guidance with RAG context
     
@@ -29,47 +139,93 @@ async def ask_tutor(request: AskTutorRequest):
         from app.models.schemas import EditorState
         editor_state = EditorState(**request.editor_state)
         
-        # Get RAG context if project_id provided
-        rag_context = ""
-        if request.project_id:
-            rag_context = await rag_service.get_rag_context(
-                query=request.user_question,
-                project_id=request.project_id,
-                current_file_content=editor_state.full_code,
-                current_file_path=editor_state.file_path
-            )
+        user_message_saved = _start_user_message_save(request, editor_state)
         
-        # Save user message to database
-        if request.session_id and supabase_service.is_available():
-            await supabase_service.save_message(
-                session_id=request.session_id,
-                role="user",
-                content=request.user_question,
-                code_context=editor_state.full_code,
-                execution_context=getattr(editor_state, 'last_execution', None)
-            )
+        rag_context = await _get_rag_context(request)
         
-        # Get AI response with RAG context
-        response = await tutor_agent.get_guidance(
-            editor_state=editor_state,
-            user_question=request.user_question,
-            model_type=request.model_type,
-            rag_context=rag_context
-        )
+        # Near-duplicate questions about the same editor state reuse a cached answer
+        workspace, question_embedding, cached = await _lookup_cached_answer(request, editor_state, rag_context)
         
-        # Save AI response to database
-        if request.session_id and supabase_service.is_available():
-            await supabase_service.save_message(
-                session_id=request.session_id,
-                role="assistant",
-                content=response.response,
-                code_context=editor_state.full_code
+        if cached:
+            response = TutorResponse(**cached)
+        else:
+            # Get AI response with RAG context
+            response = await tutor_agent.get_guidance(
+                editor_state=editor_state,
+                user_question=request.user_question,
+                model_type=request.model_type,
+                rag_context=rag_context
             )
         
+        # Saved once the response has been sent
+        background_tasks.add_task(
+            _save_answer, request, editor_state, response, user_message_saved,
+            question_embedding, workspace, bool(cached)
+        )
+        
         return response
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@router.post("/ask/stream")
+async def ask_tutor_stream(request: AskTutorRequest):
+    """
+    Ask the Shadow Tutor, streaming the answer text as it is generated
+    
+    Same inputs and side effects as /ask; the body is plain text that the
+    client can render chunk by chunk.
+    """
+    try:
+        from app.models.schemas import EditorState
+        editor_state = EditorState(**request.editor_state)
+        
+        user_message_saved = _start_user_message_save(request, editor_state)
+        rag_context = await _get_rag_context(request)
+        workspace, question_embedding, cached = await _lookup_cached_answer(request, editor_state, rag_context)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    
+    # Filled in as the answer streams; saved after the response ends,
+    # including when the client disconnects part way
+    streamed = {"chunks": [], "complete": False}
+    
+    async def answer():
+        if cached:
+            text = TutorResponse(**cached).response
+            streamed["chunks"].append(text)
+            yield text
+        else:
+            try:
+                async for chunk in tutor_agent.stream_guidance(
+                    editor_state=editor_state,
+                    user_question=request.user_question,
+                    model_type=request.model_type,
+                    rag_context=rag_context
+                ):
+                    streamed["chunks"].append(chunk)
+                    yield chunk
+            except Exception:
+                yield INTERRUPTED_NOTE
+                return
+        streamed["complete"] = True
+    
+    async def save_answer():
+        # A partial answer is kept in the history, marked, but never cached
+        text = "".join(streamed["chunks"])
+        if not streamed["complete"]:
+            text += INTERRUPTED_NOTE
+        await _save_answer(
+            request, editor_state,
+            TutorResponse(**cached) if cached else TutorResponse(response=text, hints=[], related_concepts=[]),
+            user_message_saved, question_embedding, workspace, bool(cached), streamed["complete"]
+        )
+    
+    return StreamingResponse(
+        answer(),
+        media_type="text/plain; charset=utf-8",
+        background=BackgroundTask(save_answer)
+    )
+
 @router.get("/health")
 async def tutor_health():
     """
@@ -79,7 +235,8 @@ async def tutor_health():
         "status": "healthy",
         "service": "tutor",
         "ollama_configured": True,
-        "gemini_configured": tutor_agent.gemini_model is not None
+        "gemini_configured": tutor_agent.gemini_model is not None,
+        "anthropic_configured": tutor_agent.anthropic_model is not None
     }
 
 @router.get("/models")
@@ -106,6 +263,15 @@ async def available_models():
             "description": "Powerful, fast, requires API key"
         })
     
+    # Include Anthropic if configured
+    if tutor_agent.anthropic_model:
+        models.append({
+            "id": "anthropic",
+            "name": "Claude (Anthropic)",
+            "type": "cloud",
+            "description": "Cloud model with prompt caching, requires API key"
+        })
+    
     return {"models": models}
 
 @router.post("/session/start")
@@ -155,11 +321,12 @@ async def get_session_messages(session_id: str):
     return {"messages": messages}
 
 @router.get("/session/{session_id}/history")
-async def get_code_history(session_id: str):
+async def get_code_history(session_id: str, include_code: bool = False):
     """
     Get code execution history for a session
+    Snapshot code is only included when include_code is set
     """
-    history = await supabase_service.get_code_history(session_id)
+    history = await supabase_service.get_code_history(session_id, include_code=include_code)
     return {"history": history}
 
 @router.post("/rag/index")
@@ -5,19 +5,28 @@ class Settings(BaseSettings):
     # API Configuration
     API_HOST: str = "0.0.0.0"
     API_PORT: int = 8000
+    LOG_LEVEL: str = "INFO"
     
     # Ollama Configuration
     OLLAMA_BASE_URL: str = "http://localhost:11434"
     OLLAMA_MODEL: str = "llama3"
+    OLLAMA_KEEP_ALIVE: str = "5m"
     
     # Gemini Configuration
     GEMINI_API_KEY: str = ""
     GEMINI_MODEL: str = "gemini-1.5-flash"
     
+    # Anthropic Configuration
+    ANTHROPIC_API_KEY: str = ""
+    ANTHROPIC_MODEL: str = "claude-3-5-haiku-latest"
+    
     # Supabase Configuration
     SUPABASE_URL: str = ""
     SUPABASE_KEY: str = ""
     SUPABASE_SERVICE_KEY: str = ""
+    # Gzip large request bodies; only enable if the gateway in front of
+    # PostgREST accepts Content-Encoding: gzip
+    SUPABASE_GZIP_REQUESTS: bool = False
     
     # CORS
     CORS_ORIGINS: List[str] = ["http://localhost:5174", "http://localhost:3000"]
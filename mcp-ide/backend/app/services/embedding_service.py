@@ -3,16 +3,77 @@ Embedding service for RAG (Retrieval-Augmented Generation)
 Generates embeddings for code files and enables semantic search
 Uses sentence-transformers (all-MiniLM-L6-v2) - no Ollama required!
 """
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+import functools
 import hashlib
+import os
+import re
+import numpy as np
+import orjson
 
 try:
+    import torch
     from sentence_transformers import SentenceTransformer
     SENTENCE_TRANSFORMERS_AVAILABLE = True
 except ImportError:
     SENTENCE_TRANSFORMERS_AVAILABLE = False
     print("⚠️ sentence-transformers not installed. Install with: pip install sentence-transformers")
 
+# all-MiniLM-L6-v2 truncates input at 256 word pieces, so chunks stay below it
+CHUNK_MAX_TOKENS = 200
+CHUNK_OVERLAP_TOKENS = 30
+
+# Stored vectors are halfvec (fp16, ~3 significant digits); 4 decimals on a
+# unit vector is within that precision and keeps the upload ~3x smaller
+EMBEDDING_DECIMALS = 4
+
+# Rough tokenizer: identifiers/numbers and single punctuation marks
+_TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+
+# Unindented lines that usually start a new definition
+_BOUNDARY_RE = re.compile(
+    r"^(?:export\s+)?(?:default\s+)?(?:async\s+)?"
+    r"(?:def|class|function|interface|struct|impl|fn|func|const\s+\w+\s*=)\b"
+)
+
+EMBEDDING_MODEL_NAME = 'all-MiniLM-L6-v2'
+
+# Quantize the model's Linear layers to int8 on CPU (opt-in with EMBEDDING_INT8=1).
+# Query and stored vectors must come from the same model, so switching it on or
+# off needs the project's code_embeddings cleared and re-indexed.
+EMBEDDING_INT8 = os.environ.get("EMBEDDING_INT8", "0") == "1"
+
+@functools.lru_cache(maxsize=2)
+def load_embedding_model(quantize: bool = EMBEDDING_INT8) -> "SentenceTransformer":
+    """
+    Load the sentence-transformers model once per process
+    ST_CACHE pins the download/cache directory (e.g. a CI cache)
+    """
+    model = SentenceTransformer(
+        EMBEDDING_MODEL_NAME,
+        cache_folder=os.environ.get("ST_CACHE") or None
+    )
+    if str(model.device).startswith('cuda'):
+        # Half-precision weights on GPU; outputs are normalized afterwards
+        model.half()
+    elif quantize:
+        try:
+            # int8 weights with dynamic activation scaling: ~2x faster encode
+            # on CPUs with int8 dot products, cosine > 0.99 vs fp32
+            torch.quantization.quantize_dynamic(
+                model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+            )
+        except Exception as e:
+            print(f"⚠️ int8 quantization unavailable, using fp32: {e}")
+    return model
+
+def is_int8_model(model) -> bool:
+    """Check whether a model's Linear layers were quantized to int8"""
+    if not SENTENCE_TRANSFORMERS_AVAILABLE:
+        return False
+    return any(isinstance(m, torch.ao.nn.quantized.dynamic.Linear) for m in model.modules())
+
 class EmbeddingService:
     """
     Service to generate embeddings for code and perform semantic search
@@ -26,12 +87,18 @@ class EmbeddingService:
         if SENTENCE_TRANSFORMERS_AVAILABLE:
             try:
                 # Load the model (downloads automatically on first use)
-                print("Loading embedding model: all-MiniLM-L6-v2...")
-                self.model = SentenceTransformer('all-MiniLM-L6-v2')
+                print(f"Loading embedding model: {EMBEDDING_MODEL_NAME}...")
+                self.model = load_embedding_model()
                 print("✅ Embedding model loaded successfully!")
             except Exception as e:
                 print(f"❌ Failed to load embedding model: {e}")
                 self.model = None
+        
+        # Executor for running inference off the event loop.
+        # GPU access is serialized on one thread; None means the default pool.
+        self.executor: Optional[ThreadPoolExecutor] = None
+        if self.model is not None and str(getattr(self.model, 'device', 'cpu')).startswith('cuda'):
+            self.executor = ThreadPoolExecutor(max_workers=1)
     
     def generate_embedding(self, text: str) -> Optional[List[float]]:
         """
@@ -48,14 +115,41 @@ class EmbeddingService:
             return None
         
         try:
-            # Generate embedding
-            embedding = self.model.encode(text, convert_to_numpy=True)
+            # Generate embedding (unit-norm so cosine similarity is a dot product)
+            embedding = self.model.encode(text, convert_to_numpy=True, normalize_embeddings=True)
+            if embedding.shape != (self.embedding_dimension,):
+                print(f"Unexpected embedding shape: {embedding.shape}")
+                return None
             return embedding.tolist()
                 
         except Exception as e:
             print(f"Error generating embedding: {e}")
             return None
     
+    def generate_query_embedding(self, query: str) -> Optional[List[float]]:
+        """
+        Generate embedding for a search query
+        Memoized, so repeated questions skip model inference
+        
+        Args:
+            query: Query text
+            
+        Returns:
+            Embedding vector
+        """
+        try:
+            return list(self._query_embedding(query))
+        except ValueError:
+            return None
+    
+    @functools.lru_cache(maxsize=512)
+    def _query_embedding(self, query: str) -> Tuple[float, ...]:
+        """Cached query embedding (failures raise, so they are not cached)"""
+        embedding = self.generate_embedding(query)
+        if embedding is None:
+            raise ValueError("Failed to generate query embedding")
+        return tuple(embedding)
+    
     def generate_code_embedding(self, code: str, language: str, file_path: str) -> Optional[List[float]]:
         """
         Generate embedding for code with context
@@ -68,49 +162,147 @@ class EmbeddingService:
         Returns:
             Embedding vector
         """
-        # Create rich context for better embeddings
-        context = f"""
+        return self.generate_embedding(self._code_context(code, language, file_path))
+    
+    def generate_embeddings_batch(self, texts: List[str]) -> List[Optional[List[float]]]:
+        """
+        Generate embeddings for many texts in one batched model call
+        
+        Args:
+            texts: Texts to embed
+            
+        Returns:
+            Embedding vectors in input order (None entries on failure)
+        """
+        if not self.model:
+            print("Embedding model not available")
+            return [None] * len(texts)
+        
+        if not texts:
+            return []
+        
+        try:
+            embeddings = self.model.encode(
+                texts,
+                batch_size=64,
+                convert_to_numpy=True,
+                normalize_embeddings=True
+            )
+            if embeddings.shape != (len(texts), self.embedding_dimension):
+                print(f"Unexpected embedding shape: {embeddings.shape}")
+                return [None] * len(texts)
+            return embeddings.tolist()
+        
+        except Exception as e:
+            print(f"Error generating batch embeddings: {e}")
+            return [None] * len(texts)
+    
+    def generate_code_embeddings_batch(
+        self,
+        codes: List[str],
+        languages: List[str],
+        file_paths: List[str]
+    ) -> List[Optional[List[float]]]:
+        """
+        Generate embeddings for many code files in one model call
+        
+        Args:
+            codes: Source code of each file
+            languages: Programming language of each file
+            file_paths: File path of each file
+            
+        Returns:
+            Embedding vectors in input order (None entries on failure)
+        """
+        contexts = [
+            self._code_context(code, language, file_path)
+            for code, language, file_path in zip(codes, languages, file_paths)
+        ]
+        return self.generate_embeddings_batch(contexts)
+    
+    def _code_context(self, code: str, language: str, file_path: str) -> str:
+        """Create rich context for better embeddings"""
+        return f"""
 File: {file_path}
 Language: {language}
 
 Code:
 {code}
 """
-        return self.generate_embedding(context)
     
-    def chunk_code(self, code: str, max_chunk_size: int = 500) -> List[str]:
+    def chunk_code(
+        self,
+        code: str,
+        max_tokens: int = CHUNK_MAX_TOKENS,
+        overlap: int = CHUNK_OVERLAP_TOKENS
+    ) -> List[Dict]:
         """
-        Split code into chunks for embedding
-        Large files are split into smaller chunks
+        Split code into overlapping chunks for embedding
+        Chunks prefer to end just before a top-level definition and fall
+        back to plain line windows. Token counts are approximate.
         
         Args:
             code: Source code
-            max_chunk_size: Maximum lines per chunk
+            max_tokens: Maximum tokens per chunk
+            overlap: Tokens repeated at the start of the next chunk
             
         Returns:
-            List of code chunks
+            List of {content, start_line, end_line} (1-based, inclusive)
         """
         lines = code.split('\n')
+        tokens = [len(_TOKEN_RE.findall(line)) for line in lines]
         
-        if len(lines) <= max_chunk_size:
-            return [code]
+        if sum(tokens) <= max_tokens:
+            return [{'content': code, 'start_line': 1, 'end_line': len(lines)}]
         
         chunks = []
-        current_chunk = []
-        
-        for line in lines:
-            current_chunk.append(line)
+        start = 0
+        while start < len(lines):
+            # Grow the window up to max_tokens (always at least one line)
+            end = start
+            used = 0
+            while end < len(lines) and (end == start or used + tokens[end] <= max_tokens):
+                used += tokens[end]
+                end += 1
             
-            if len(current_chunk) >= max_chunk_size:
-                chunks.append('\n'.join(current_chunk))
-                current_chunk = []
-        
-        # Add remaining lines
-        if current_chunk:
-            chunks.append('\n'.join(current_chunk))
+            # Prefer to cut just before a top-level definition in the back half
+            if end < len(lines):
+                for cut in range(end - 1, start + (end - start) // 2, -1):
+                    if _BOUNDARY_RE.match(lines[cut]):
+                        end = cut
+                        break
+            
+            chunks.append({
+                'content': '\n'.join(lines[start:end]),
+                'start_line': start + 1,
+                'end_line': end
+            })
+            
+            if end >= len(lines):
+                break
+            
+            # Step back so the next chunk overlaps this one
+            next_start = end
+            carried = 0
+            while next_start > start + 1 and carried + tokens[next_start - 1] <= overlap:
+                next_start -= 1
+                carried += tokens[next_start]
+            start = next_start
         
         return chunks
     
+    def quantize_embedding(self, embedding: List[float]) -> np.ndarray:
+        """
+        Round a vector for storage (serialized by orjson's numpy option)
+        
+        Args:
+            embedding: Embedding vector
+            
+        Returns:
+            float32 array rounded to EMBEDDING_DECIMALS
+        """
+        return np.round(np.asarray(embedding, dtype=np.float32), EMBEDDING_DECIMALS)
+    
     def compute_content_hash(self, content: str) -> str:
         """
         Compute hash of content to detect changes
@@ -125,7 +317,8 @@ Code:
     
     def cosine_similarity(self, vec1: List[float], vec2: List[float]) -> float:
         """
-        Calculate cosine similarity between two vectors
+        Calculate cosine similarity between two unit-norm vectors
+        No validation: embeddings are checked and normalized when generated
         
         Args:
             vec1: First vector
@@ -134,17 +327,95 @@ Code:
         Returns:
             Similarity score (0-1)
         """
+        return float(np.dot(vec1, vec2))
+    
+    def _safe_cosine(self, vec1: List[float], vec2: List[float]) -> float:
+        """
+        Calculate cosine similarity between two untrusted vectors
+        
+        Args:
+            vec1: First vector
+            vec2: Second vector
+            
+        Returns:
+            Similarity score (0-1), 0.0 for empty or mismatched vectors
+        """
         if not vec1 or not vec2 or len(vec1) != len(vec2):
             return 0.0
         
-        dot_product = sum(a * b for a, b in zip(vec1, vec2))
-        magnitude1 = sum(a * a for a in vec1) ** 0.5
-        magnitude2 = sum(b * b for b in vec2) ** 0.5
+        a = np.asarray(vec1, dtype=np.float32)
+        b = np.asarray(vec2, dtype=np.float32)
+        magnitude = np.linalg.norm(a) * np.linalg.norm(b)
         
-        if magnitude1 == 0 or magnitude2 == 0:
+        if magnitude == 0:
             return 0.0
         
-        return dot_product / (magnitude1 * magnitude2)
+        return float(np.dot(a, b) / magnitude)
+    
+    def build_embedding_matrix(self, code_embeddings: List[Dict]) -> Tuple[List[Dict], np.ndarray]:
+        """
+        Stack stored embeddings into one row-normalized (N, d) matrix
+        
+        Args:
+            code_embeddings: Rows with an embedding (list or pgvector "[...]" string)
+            
+        Returns:
+            (rows without their embedding, float32 matrix), in matching order
+        """
+        items = []
+        vectors = []
+        for item in code_embeddings:
+            embedding = item.get('embedding')
+            if isinstance(embedding, str):
+                embedding = orjson.loads(embedding)
+            if not embedding:
+                continue
+            
+            items.append({k: v for k, v in item.items() if k != 'embedding'})
+            vectors.append(embedding)
+        
+        if not vectors:
+            return [], np.empty((0, 0), dtype=np.float32)
+        
+        matrix = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return items, matrix / norms
+    
+    def search_embedding_matrix(
+        self,
+        query_embedding: List[float],
+        items: List[Dict],
+        matrix: np.ndarray,
+        top_k: int = 3
+    ) -> List[Dict]:
+        """
+        Rank rows of a normalized embedding matrix against a query (one matmul)
+        
+        Args:
+            query_embedding: Query vector
+            items: Row metadata from build_embedding_matrix
+            matrix: Row-normalized embeddings from build_embedding_matrix
+            top_k: Number of results to return
+            
+        Returns:
+            Top K rows with similarity scores, highest first
+        """
+        if not items or matrix.shape[1] != len(query_embedding):
+            return []
+        
+        query = np.asarray(query_embedding, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if norm == 0:
+            return []
+        
+        scores = matrix @ (query / norm)
+        
+        k = min(top_k, len(items))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        
+        return [{**items[i], 'similarity': float(scores[i])} for i in top]
     
     def search_similar_code(
         self, 
@@ -163,23 +434,8 @@ Code:
         Returns:
             Top K most similar code snippets with scores
         """
-        results = []
-        
-        for item in code_embeddings:
-            if 'embedding' not in item or not item['embedding']:
-                continue
-            
-            similarity = self.cosine_similarity(query_embedding, item['embedding'])
-            
-            results.append({
-                **item,
-                'similarity': similarity
-            })
-        
-        # Sort by similarity (highest first)
-        results.sort(key=lambda x: x['similarity'], reverse=True)
-        
-        return results[:top_k]
+        items, matrix = self.build_embedding_matrix(code_embeddings)
+        return self.search_embedding_matrix(query_embedding, items, matrix, top_k)
 
 # Global instance
 embedding_service = EmbeddingService()
@@ -1,8 +1,32 @@
+import gzip
+import orjson
+import logging
 import httpx
 from app.core.config import settings
-from typing import Optional, Dict, List
+from typing import Optional, Dict, List, Tuple
 from datetime import datetime
 import uuid
+from app.core.cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# Seconds a cached file/project row is trusted before re-fetching
+FILE_CACHE_TTL = 5.0
+
+# Rows per page when listing files for RAG indexing
+INDEX_PAGE_SIZE = 1000
+
+# Seconds the first page of a file's version history is cached
+HISTORY_CACHE_TTL = 10.0
+
+# Request bodies above this size are gzipped (when SUPABASE_GZIP_REQUESTS is on)
+GZIP_MIN_BYTES = 4096
+
+def _maybe_gzip(payload: bytes) -> Tuple[bytes, Dict[str, str]]:
+    """Gzip a request body if compression is enabled and it is large enough"""
+    if not settings.SUPABASE_GZIP_REQUESTS or len(payload) <= GZIP_MIN_BYTES:
+        return payload, {}
+    return gzip.compress(payload, compresslevel=5), {"Content-Encoding": "gzip"}
 
 class FileService:
     """
@@ -18,6 +42,41 @@ class FileService:
             "Content-Type": "application/json",
             "Prefer": "return=representation"
         }
+        # One pooled HTTP/2 client for all Supabase calls; concurrent
+        # requests multiplex over the same TLS connection
+        self._client = httpx.AsyncClient(
+            base_url=f"{self.base_url}/rest/v1",
+            headers=self.headers,
+            http2=True,
+            timeout=10.0,
+            limits=httpx.Limits(
+                max_keepalive_connections=10,
+                max_connections=50,
+                keepalive_expiry=30
+            )
+        )
+        
+        # Hot rows (editor autosave, RAG lookups), invalidated on writes
+        self._file_cache = TTLCache(maxsize=256, ttl=FILE_CACHE_TTL)
+        self._project_cache = TTLCache(maxsize=64, ttl=FILE_CACHE_TTL)
+        # First history page per file as (limit, rows); saves add a version
+        self._history_cache = TTLCache(maxsize=256, ttl=HISTORY_CACHE_TTL)
+    
+    async def aclose(self):
+        """Close the pooled HTTP client"""
+        await self._client.aclose()
+    
+    async def check_http2(self):
+        """Warn if Supabase did not negotiate HTTP/2 for the shared client"""
+        if not self.is_available():
+            return
+        
+        try:
+            response = await self._client.head("/projects", params={"limit": 1})
+            if response.http_version != "HTTP/2":
+                logger.warning("Supabase connection fell back to %s", response.http_version)
+        except Exception as e:
+            logger.warning("Could not check Supabase HTTP version: %s", e)
     
     def is_available(self) -> bool:
         """Check if Supabase is configured"""
@@ -40,19 +99,17 @@ class FileService:
                 "description": description
             }
             
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    f"{self.base_url}/rest/v1/projects",
-                    headers=self.headers,
-                    json=data,
-                    timeout=10.0
-                )
-                
-                if response.status_code in [200, 201]:
-                    return response.json()[0] if response.json() else None
-                return None
+            response = await self._client.post(
+                "/projects",
+                content=orjson.dumps(data)
+            )
+            
+            if response.status_code in [200, 201]:
+                created = orjson.loads(response.content)
+                return created[0] if created else None
+            return None
         except Exception as e:
-            print(f"Error creating project: {e}")
+            logger.error("Error creating project: %s", e)
             return None
     
     async def get_projects(self, user_id: Optional[str] = None, limit: int = 50) -> List[Dict]:
@@ -61,18 +118,17 @@ class FileService:
             return []
         
         try:
-            url = f"{self.base_url}/rest/v1/projects?order=updated_at.desc&limit={limit}"
+            url = f"/projects?order=updated_at.desc&limit={limit}"
             if user_id:
                 url += f"&user_id=eq.{user_id}"
             
-            async with httpx.AsyncClient() as client:
-                response = await client.get(url, headers=self.headers, timeout=10.0)
-                
-                if response.status_code == 200:
-                    return response.json()
-                return []
+            response = await self._client.get(url)
+            
+            if response.status_code == 200:
+                return orjson.loads(response.content)
+            return []
         except Exception as e:
-            print(f"Error getting projects: {e}")
+            logger.error("Error getting projects: %s", e)
             return []
     
     async def get_project(self, project_id: str) -> Optional[Dict]:
@@ -80,20 +136,21 @@ class FileService:
         if not self.is_available():
             return None
         
+        cached = self._project_cache.get(project_id)
+        if cached:
+            return cached
+        
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.get(
-                    f"{self.base_url}/rest/v1/projects?id=eq.{project_id}",
-                    headers=self.headers,
-                    timeout=10.0
-                )
-                
-                if response.status_code == 200:
-                    data = response.json()
-                    return data[0] if data else None
-                return None
+            response = await self._client.get(f"/projects?id=eq.{project_id}")
+            
+            if response.status_code == 200:
+                data = orjson.loads(response.content)
+                if data:
+                    self._project_cache.set(project_id, data[0])
+                return data[0] if data else None
+            return None
         except Exception as e:
-            print(f"Error getting project: {e}")
+            logger.error("Error getting project: %s", e)
             return None
     
     # ==================== FILES ====================
@@ -128,21 +185,24 @@ class FileService:
                 "is_folder": is_folder
             }
             
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    f"{self.base_url}/rest/v1/files",
-                    headers=self.headers,
-                    json=data,
-                    timeout=10.0
-                )
-                
-                if response.status_code in [200, 201]:
-                    return response.json()[0] if response.json() else None
-                else:
-                    print(f"Error creating file: {response.status_code} - {response.text}")
-                return None
+            # File content dominates the body; compress it when large
+            body, extra_headers = _maybe_gzip(orjson.dumps(data))
+            response = await self._client.post(
+                "/files",
+                content=body,
+                headers=extra_headers
+            )
+            
+            if response.status_code in [200, 201]:
+                created = orjson.loads(response.content)
+                if created:
+                    self._file_cache.set(created[0]['id'], created[0])
+                return created[0] if created else None
+            else:
+                logger.error("Error creating file: %s - %s", response.status_code, response.text)
+            return None
         except Exception as e:
-            print(f"Error creating file: {e}")
+            logger.error("Error creating file: %s", e)
             return None
     
     async def get_project_files(self, project_id: str) -> List[Dict]:
@@ -151,126 +211,115 @@ class FileService:
             return []
         
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.get(
-                    f"{self.base_url}/rest/v1/files?project_id=eq.{project_id}&order=path.asc",
-                    headers=self.headers,
-                    timeout=10.0
+            response = await self._client.get(f"/files?project_id=eq.{project_id}&order=path.asc")
+            
+            if response.status_code == 200:
+                return orjson.loads(response.content)
+            return []
+        except Exception as e:
+            logger.error("Error getting files: %s", e)
+            return []
+    
+    async def get_project_files_for_indexing(self, project_id: str) -> List[Dict]:
+        """
+        Get the non-empty, non-folder files of a project for RAG indexing
+        Only the columns the indexer needs, fetched in pages of INDEX_PAGE_SIZE
+        """
+        if not self.is_available():
+            return []
+        
+        files = []
+        try:
+            while True:
+                start = len(files)
+                response = await self._client.get(
+                    "/files",
+                    params={
+                        "project_id": f"eq.{project_id}",
+                        "is_folder": "eq.false",
+                        "content": "neq.",
+                        "select": "id,path,language,content",
+                        "order": "path.asc"
+                    },
+                    headers={
+                        "Range-Unit": "items",
+                        "Range": f"{start}-{start + INDEX_PAGE_SIZE - 1}"
+                    }
                 )
                 
-                if response.status_code == 200:
-                    return response.json()
-                return []
+                if response.status_code not in [200, 206]:
+                    break
+                
+                page = orjson.loads(response.content)
+                files.extend(page)
+                if len(page) < INDEX_PAGE_SIZE:
+                    break
+            
+            return files
         except Exception as e:
-            print(f"Error getting files: {e}")
-            return []
+            logger.error("Error getting files for indexing: %s", e)
+            return files
     
     async def get_file(self, file_id: str) -> Optional[Dict]:
         """Get a specific file"""
         if not self.is_available():
             return None
         
+        cached = self._file_cache.get(file_id)
+        if cached:
+            return cached
+        
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.get(
-                    f"{self.base_url}/rest/v1/files?id=eq.{file_id}",
-                    headers=self.headers,
-                    timeout=10.0
-                )
-                
-                if response.status_code == 200:
-                    data = response.json()
-                    return data[0] if data else None
-                return None
+            response = await self._client.get(f"/files?id=eq.{file_id}")
+            
+            if response.status_code == 200:
+                data = orjson.loads(response.content)
+                if data:
+                    self._file_cache.set(file_id, data[0])
+                return data[0] if data else None
+            return None
         except Exception as e:
-            print(f"Error getting file: {e}")
+            logger.error("Error getting file: %s", e)
             return None
     
     async def update_file(self, file_id: str, content: str) -> bool:
-        """Update file content and auto-generate embedding"""
+        """Update file content (embedding is regenerated in the background)"""
         if not self.is_available():
-            print("⚠️ Supabase not available for file update")
+            logger.warning("⚠️ Supabase not available for file update")
             return False
         
-        print(f"🔄 Updating file {file_id}...")
+        logger.debug("🔄 Updating file %s...", file_id)
         
         try:
             data = {"content": content}
             
-            async with httpx.AsyncClient() as client:
-                response = await client.patch(
-                    f"{self.base_url}/rest/v1/files?id=eq.{file_id}",
-                    headers=self.headers,
-                    json=data,
-                    timeout=10.0
-                )
+            body, extra_headers = _maybe_gzip(orjson.dumps(data))
+            response = await self._client.patch(
+                f"/files?id=eq.{file_id}",
+                content=body,
+                headers=extra_headers
+            )
+            
+            if response.status_code in [200, 204]:
+                logger.debug("✅ File content updated in database")
                 
-                if response.status_code in [200, 204]:
-                    print(f"✅ File content updated in database")
-                    
-                    # Auto-generate embedding in background
-                    print(f"🔍 Attempting to generate embedding...")
-                    try:
-                        from app.services.embedding_service import embedding_service
-                        from app.services.supabase_service import supabase_service
-                        
-                        # Get file info
-                        file_info = await self.get_file(file_id)
-                        if file_info:
-                            print(f"   File: {file_info.get('path', 'unknown')}")
-                            print(f"   Language: {file_info.get('language', 'unknown')}")
-                            print(f"   Is folder: {file_info.get('is_folder', False)}")
-                            
-                            if not file_info.get('is_folder', False):
-                                # Generate embedding
-                                print(f"🤖 Generating embedding...")
-                                embedding = embedding_service.generate_code_embedding(
-                                    code=content,
-                                    language=file_info['language'],
-                                    file_path=file_info['path']
-                                )
-                                
-                                if embedding:
-                                    print(f"✅ Embedding generated (dim: {len(embedding)})")
-                                    
-                                    # Compute content hash
-                                    content_hash = embedding_service.compute_content_hash(content)
-                                    print(f"   Content hash: {content_hash[:16]}...")
-                                    
-                                    # Save embedding (will update if exists)
-                                    print(f"💾 Saving embedding to database...")
-                                    result = await supabase_service.save_code_embedding(
-                                        file_id=file_id,
-                                        file_path=file_info['path'],
-                                        language=file_info['language'],
-                                        code_content=content,
-                                        embedding=embedding,
-                                        content_hash=content_hash
-                                    )
-                                    
-                                    if result:
-                                        print(f"✅ Auto-embedded: {file_info['path']}")
-                                    else:
-                                        print(f"❌ Failed to save embedding")
-                                else:
-                                    print(f"❌ Failed to generate embedding")
-                            else:
-                                print(f"⏭️  Skipped (folder)")
-                        else:
-                            print(f"❌ Could not get file info")
-                    except Exception as e:
-                        print(f"⚠️ Auto-embedding failed (non-critical): {e}")
-                        import traceback
-                        traceback.print_exc()
-                    
-                    return True
+                # PATCH returns the updated row (Prefer: return=representation)
+                rows = orjson.loads(response.content) if response.status_code == 200 else []
+                file_info = rows[0] if rows else None
+                if file_info:
+                    self._file_cache.set(file_id, file_info)
                 else:
-                    print(f"❌ Failed to update file: {response.status_code}")
-                return False
+                    self._file_cache.pop(file_id)
+                self._history_cache.pop(file_id)
+                
+                # Embedding is queued by the files trigger and done by the
+                # background worker (rag_service.run_embedding_worker)
+                return True
+            else:
+                logger.error("❌ Failed to update file: %s", response.status_code)
+            return False
         except Exception as e:
-            print(f"❌ Error updating file: {e}")
-            import traceback
-            traceback.print_exc()
+            logger.exception("❌ Error updating file: %s", e)
             return False
     
     async def delete_file(self, file_id: str) -> bool:
@@ -279,16 +328,13 @@ class FileService:
             return False
         
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.delete(
-                    f"{self.base_url}/rest/v1/files?id=eq.{file_id}",
-                    headers=self.headers,
-                    timeout=10.0
-                )
-                
-                return response.status_code in [200, 204]
+            response = await self._client.delete(f"/files?id=eq.{file_id}")
+            self._file_cache.pop(file_id)
+            self._history_cache.pop(file_id)
+            
+            return response.status_code in [200, 204]
         except Exception as e:
-            print(f"Error deleting file: {e}")
+            logger.error("Error deleting file: %s", e)
             return False
     
     async def set_active_file(self, project_id: str, file_id: str) -> bool:
@@ -297,48 +343,64 @@ class FileService:
             return False
         
         try:
-            async with httpx.AsyncClient() as client:
-                # Deactivate all files in project
-                await client.patch(
-                    f"{self.base_url}/rest/v1/files?project_id=eq.{project_id}",
-                    headers=self.headers,
-                    json={"is_active": False},
-                    timeout=10.0
-                )
-                
-                # Activate the selected file
-                response = await client.patch(
-                    f"{self.base_url}/rest/v1/files?id=eq.{file_id}",
-                    headers=self.headers,
-                    json={"is_active": True},
-                    timeout=10.0
-                )
-                
-                return response.status_code in [200, 204]
+            # Deactivate the others and activate the selected file in one statement
+            response = await self._client.post(
+                "/rpc/set_active_file",
+                content=orjson.dumps({"p_project": project_id, "p_file": file_id})
+            )
+            # is_active changed on every file in the project
+            self._file_cache.clear()
+            
+            return response.status_code in [200, 204]
         except Exception as e:
-            print(f"Error setting active file: {e}")
+            logger.error("Error setting active file: %s", e)
             return False
     
     # ==================== FILE VERSIONS ====================
     
-    async def get_file_history(self, file_id: str, limit: int = 10) -> List[Dict]:
-        """Get file version history"""
+    async def get_file_history(
+        self,
+        file_id: str,
+        limit: int = 10,
+        before: Optional[str] = None
+    ) -> List[Dict]:
+        """
+        Get file version history, newest first
+        
+        Args:
+            file_id: File ID
+            limit: Versions per page
+            before: created_at of the last version already seen (next page)
+        """
         if not self.is_available():
             return []
         
+        # The first page is what the history panel opens with
+        if before is None:
+            cached = self._history_cache.get(file_id)
+            if cached and cached[0] >= limit:
+                return cached[1][:limit]
+        
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.get(
-                    f"{self.base_url}/rest/v1/file_versions?file_id=eq.{file_id}&order=created_at.desc&limit={limit}",
-                    headers=self.headers,
-                    timeout=10.0
-                )
-                
-                if response.status_code == 200:
-                    return response.json()
-                return []
+            params = {"file_id": f"eq.{file_id}", "order": "created_at.desc"}
+            if before:
+                # Keyset paging instead of OFFSET
+                params["created_at"] = f"lt.{before}"
+            
+            response = await self._client.get(
+                "/file_versions",
+                params=params,
+                headers={"Range-Unit": "items", "Range": f"0-{limit - 1}"}
+            )
+            
+            if response.status_code in [200, 206]:
+                history = orjson.loads(response.content)
+                if before is None:
+                    self._history_cache.set(file_id, (limit, history))
+                return history
+            return []
         except Exception as e:
-            print(f"Error getting file history: {e}")
+            logger.error("Error getting file history: %s", e)
             return []
 
 # Global instance
@@ -2,10 +2,29 @@
 RAG (Retrieval-Augmented Generation) Service
 Retrieves relevant code context for AI responses
 """
-from typing import List, Dict, Optional
+import asyncio
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Optional, Tuple
 from app.services.embedding_service import embedding_service
 from app.services.supabase_service import supabase_service
 from app.services.file_service import file_service
+from app.core.cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# One encode thread: torch already spreads each batch over its intra-op
+# thread pool, so parallel encode threads would oversubscribe the cores
+_embed_executor = ThreadPoolExecutor(max_workers=1)
+
+# Shards per indexing run; one shard is stored while the next is encoded
+INDEX_SHARDS = 4
+
+# Embedding jobs claimed per worker pass, and idle wait between polls
+EMBEDDING_JOB_BATCH = 16
+EMBEDDING_JOB_POLL_SECONDS = 2.0
+EMBEDDING_JOB_RETRY_SECONDS = 30.0
 
 class RAGService:
     """
@@ -13,6 +32,13 @@ class RAGService:
     Finds relevant code context for user queries
     """
     
+    def __init__(self):
+        # Search results for recent (project, query) pairs
+        self._query_cache = TTLCache(maxsize=128, ttl=60.0)
+        # Normalized embedding matrix per project for the Python search fallback
+        # (short-lived: deleted files drop their embeddings without telling us)
+        self._project_matrix_cache = TTLCache(maxsize=32, ttl=60.0)
+    
     async def index_project_files(self, project_id: str) -> Dict:
         """
         Generate and store embeddings for all files in a project
@@ -25,8 +51,8 @@ class RAGService:
             Status dict with counts
         """
         try:
-            # Get all files in project
-            files = await file_service.get_project_files(project_id)
+            # Get indexable files (folders and empty files are filtered by the query)
+            files = await file_service.get_project_files_for_indexing(project_id)
             
             indexed_count = 0
             skipped_count = 0
@@ -40,61 +66,55 @@ class RAGService:
                 for emb in embeddings:
                     existing_embeddings[emb['file_id']] = emb.get('content_hash')
             
+            # Work out which files actually need (re-)embedding,
+            # grouped by content so identical files are embedded once
+            to_embed: Dict[str, List[Dict]] = {}
             for file in files:
-                # Skip folders
-                if file.get('is_folder', False):
-                    skipped_count += 1
-                    continue
+                # Check if file already has embedding with same content
+                content_hash = embedding_service.compute_content_hash(file['content'])
                 
-                # Skip empty files
-                if not file.get('content'):
-                    skipped_count += 1
+                if file['id'] in existing_embeddings:
+                    if existing_embeddings[file['id']] == content_hash:
+                        # Content unchanged, skip
+                        skipped_count += 1
+                        logger.debug("⏭️  Skipped (unchanged): %s", file['path'])
+                        continue
+                    else:
+                        # Content changed, will update
+                        logger.debug("🔄 Updating: %s", file['path'])
+                
+                to_embed.setdefault(content_hash, []).append(file)
+            
+            # Reuse vectors already stored for identical content
+            known_embeddings = {}
+            if to_embed and supabase_service.is_available():
+                known_embeddings = await supabase_service.get_embeddings_by_hash(list(to_embed))
+            
+            # Shards queue on the encode thread; their uploads overlap the next encode
+            shards = self._split_shards(list(to_embed.items()), INDEX_SHARDS)
+            results = await asyncio.gather(
+                *[
+                    self._index_shard(shard, known_embeddings, existing_embeddings)
+                    for shard in shards
+                ],
+                return_exceptions=True
+            )
+            
+            for shard, result in zip(shards, results):
+                if isinstance(result, Exception):
+                    shard_files = sum(len(group) for _, group in shard)
+                    logger.error("Error indexing %s files: %s", shard_files, result)
+                    error_count += shard_files
                     continue
                 
-                try:
-                    # Check if file already has embedding with same content
-                    content_hash = embedding_service.compute_content_hash(file['content'])
-                    
-                    if file['id'] in existing_embeddings:
-                        if existing_embeddings[file['id']] == content_hash:
-                            # Content unchanged, skip
-                            skipped_count += 1
-                            print(f"⏭️  Skipped (unchanged): {file['path']}")
-                            continue
-                        else:
-                            # Content changed, will update
-                            print(f"🔄 Updating: {file['path']}")
-                    
-                    # Generate embedding
-                    embedding = embedding_service.generate_code_embedding(
-                        code=file['content'],
-                        language=file['language'],
-                        file_path=file['path']
-                    )
-                    
-                    if embedding and supabase_service.is_available():
-                        # Store in database
-                        await supabase_service.save_code_embedding(
-                            file_id=file['id'],
-                            file_path=file['path'],
-                            language=file['language'],
-                            code_content=file['content'],
-                            embedding=embedding,
-                            content_hash=content_hash
-                        )
-                        
-                        if file['id'] in existing_embeddings:
-                            updated_count += 1
-                            print(f"✅ Updated: {file['path']}")
-                        else:
-                            indexed_count += 1
-                            print(f"✅ Indexed: {file['path']}")
-                    else:
-                        error_count += 1
-                        
-                except Exception as e:
-                    print(f"Error indexing file {file['path']}: {e}")
-                    error_count += 1
+                indexed, updated, failed = result
+                indexed_count += indexed
+                updated_count += updated
+                error_count += len(failed)
+            
+            if indexed_count or updated_count:
+                # Cached search results may now be stale
+                self.clear_search_caches()
             
             return {
                 'success': True,
@@ -106,12 +126,255 @@ class RAGService:
             }
             
         except Exception as e:
-            print(f"Error indexing project: {e}")
+            logger.error("Error indexing project: %s", e)
             return {
                 'success': False,
                 'error': str(e)
             }
     
+    def _split_shards(self, items: List, shard_count: int) -> List[List]:
+        """Split items into at most shard_count contiguous shards"""
+        if not items:
+            return []
+        
+        shard_size = -(-len(items) // shard_count)
+        return [items[i:i + shard_size] for i in range(0, len(items), shard_size)]
+    
+    async def _index_shard(
+        self,
+        shard: List[Tuple[str, List[Dict]]],
+        known_embeddings: Dict[str, List[List[float]]],
+        existing_embeddings: Dict[str, str]
+    ) -> Tuple[int, int, List[str]]:
+        """
+        Embed one shard of (content_hash, files) groups on the encode thread
+        and store it with one bulk upsert. Each content is split into chunks;
+        only contents without stored chunk vectors go through the model.
+        
+        Returns:
+            (indexed, updated, failed) for the shard, failed being the
+            ids of files that could not be embedded or stored
+        """
+        loop = asyncio.get_running_loop()
+        # A GPU model brings its own single-thread executor
+        executor = embedding_service.executor or _embed_executor
+        chunks_by_hash, vectors_by_hash = await loop.run_in_executor(
+            executor,
+            self._prepare_shard,
+            shard,
+            known_embeddings
+        )
+        
+        indexed_count = 0
+        updated_count = 0
+        failed = []
+        
+        rows = []
+        written = []
+        for content_hash, group in shard:
+            vectors = vectors_by_hash.get(content_hash)
+            for file in group:
+                if not vectors or not all(vectors):
+                    logger.error("Error indexing file %s: no embedding", file['path'])
+                    failed.append(file['id'])
+                    continue
+                
+                rows.extend(self._chunk_rows(file, content_hash, chunks_by_hash[content_hash], vectors))
+                written.append((content_hash, file))
+        
+        saved = False
+        if rows and supabase_service.is_available():
+            saved = await supabase_service.save_code_embeddings_bulk(rows)
+        
+        if not saved:
+            return indexed_count, updated_count, failed + [file['id'] for _, file in written]
+        
+        # Changed files may now have fewer chunks; drop the tail only after
+        # the new chunks are stored, so a failed upsert keeps the old ones
+        chunk_counts = {
+            file['id']: len(chunks_by_hash[content_hash])
+            for content_hash, file in written
+            if file['id'] in existing_embeddings
+        }
+        if chunk_counts:
+            await supabase_service.delete_stale_chunks(chunk_counts)
+        
+        for _, file in written:
+            if file['id'] in existing_embeddings:
+                updated_count += 1
+                logger.debug("✅ Updated: %s", file['path'])
+            else:
+                indexed_count += 1
+                logger.debug("✅ Indexed: %s", file['path'])
+        
+        return indexed_count, updated_count, failed
+    
+    async def process_embedding_jobs(self, limit: int = EMBEDDING_JOB_BATCH) -> Optional[int]:
+        """
+        Claim queued embedding jobs and embed the files in one batch
+        Jobs stay leased until the embeddings are stored; failed ones
+        are released so a later pass retries them
+        
+        Returns:
+            Number of jobs claimed, or None if the queue is unavailable
+        """
+        jobs = await supabase_service.claim_embedding_jobs(limit)
+        if jobs is None:
+            return None
+        
+        existing_embeddings = {}
+        to_embed: Dict[str, List[Dict]] = {}
+        emptied = []
+        for file in jobs:
+            # Empty files have nothing to embed; drop chunks of their old content
+            if not file.get('content'):
+                emptied.append(file['id'])
+                continue
+            content_hash = embedding_service.compute_content_hash(file['content'])
+            if file.get('embedded_hash') == content_hash:
+                continue
+            if file.get('embedded_hash'):
+                existing_embeddings[file['id']] = file['embedded_hash']
+            to_embed.setdefault(content_hash, []).append(file)
+        
+        failed = []
+        if emptied:
+            if await supabase_service.delete_code_embeddings(emptied):
+                self.clear_search_caches()
+            else:
+                failed.extend(emptied)
+        
+        if to_embed:
+            try:
+                known_embeddings = await supabase_service.get_embeddings_by_hash(list(to_embed))
+                indexed, updated, not_embedded = await self._index_shard(
+                    list(to_embed.items()),
+                    known_embeddings,
+                    existing_embeddings
+                )
+            except Exception as e:
+                indexed = updated = 0
+                not_embedded = [file['id'] for group in to_embed.values() for file in group]
+                logger.error("Error embedding %s queued files: %s", len(not_embedded), e)
+            failed.extend(not_embedded)
+            
+            if indexed or updated:
+                # Cached search results may now be stale
+                self.clear_search_caches()
+        
+        failed_ids = set(failed)
+        await supabase_service.complete_embedding_jobs(
+            [file['id'] for file in jobs if file['id'] not in failed_ids],
+            failed
+        )
+        
+        return len(jobs)
+    
+    async def run_embedding_worker(self):
+        """
+        Background loop that drains embedding_jobs
+        Saves only enqueue a job, so the editor never waits on the model
+        """
+        if not supabase_service.is_available():
+            return
+        
+        while True:
+            try:
+                claimed = await self.process_embedding_jobs()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("⚠️ Embedding worker error: %s", e)
+                claimed = None
+            
+            if claimed is None:
+                # Queue missing or Supabase down; back off
+                await asyncio.sleep(EMBEDDING_JOB_RETRY_SECONDS)
+            elif claimed < EMBEDDING_JOB_BATCH:
+                await asyncio.sleep(EMBEDDING_JOB_POLL_SECONDS)
+    
+    def _prepare_shard(
+        self,
+        shard: List[Tuple[str, List[Dict]]],
+        known_embeddings: Dict[str, List[List[float]]]
+    ) -> Tuple[Dict[str, List[Dict]], Dict[str, List[Optional[List[float]]]]]:
+        """
+        Chunk a shard and embed the contents without stored vectors
+        (runs on the thread pool)
+        
+        Returns:
+            (chunks_by_hash, vectors_by_hash)
+        """
+        # Chunk each distinct content once
+        chunks_by_hash = {
+            content_hash: embedding_service.chunk_code(group[0]['content'])
+            for content_hash, group in shard
+        }
+        
+        vectors_by_hash = {}
+        missing = []
+        for content_hash, group in shard:
+            known = known_embeddings.get(content_hash)
+            if known and len(known) == len(chunks_by_hash[content_hash]):
+                vectors_by_hash[content_hash] = known
+            else:
+                missing.append((content_hash, group[0]))
+        
+        if missing:
+            embedded = self._embed_chunks(
+                [(file, chunks_by_hash[content_hash]) for content_hash, file in missing]
+            )
+            for (content_hash, _), vectors in zip(missing, embedded):
+                vectors_by_hash[content_hash] = vectors
+        
+        return chunks_by_hash, vectors_by_hash
+    
+    def _embed_chunks(self, items: List[Tuple[Dict, List[Dict]]]) -> List[List[Optional[List[float]]]]:
+        """
+        Embed the chunks of several files in one batch (runs on the thread pool)
+        
+        Args:
+            items: (file, chunks) pairs
+            
+        Returns:
+            Chunk vectors for each file, in input order
+        """
+        embeddings = embedding_service.generate_code_embeddings_batch(
+            codes=[chunk['content'] for _, chunks in items for chunk in chunks],
+            languages=[file['language'] for file, chunks in items for _ in chunks],
+            file_paths=[file['path'] for file, chunks in items for _ in chunks]
+        )
+        
+        vectors = []
+        offset = 0
+        for _, chunks in items:
+            vectors.append(embeddings[offset:offset + len(chunks)])
+            offset += len(chunks)
+        return vectors
+    
+    def _chunk_rows(
+        self,
+        file: Dict,
+        content_hash: str,
+        chunks: List[Dict],
+        vectors: List[List[float]]
+    ) -> List[Dict]:
+        """Build code_embeddings rows (one per chunk) for a file"""
+        return [
+            {
+                'file_id': file['id'],
+                'chunk_index': chunk_index,
+                'start_line': chunk['start_line'],
+                'end_line': chunk['end_line'],
+                'file_path': file['path'],
+                'language': file['language'],
+                'code_content': chunk['content'],
+                'embedding': embedding_service.quantize_embedding(vector),
+                'content_hash': content_hash
+            }
+            for chunk_index, (chunk, vector) in enumerate(zip(chunks, vectors))
+        ]
+    
     async def search_codebase(
         self, 
         query: str, 
@@ -129,38 +392,78 @@ class RAGService:
         Returns:
             List of relevant code snippets with context
         """
+        cache_key = (project_id, top_k, hashlib.sha1(query.encode()).hexdigest())
+        cached = self._query_cache.get(cache_key)
+        if cached is not None:
+            return cached
+        
         try:
-            # Generate embedding for query
-            query_embedding = embedding_service.generate_embedding(query)
+            # Generate embedding for query off the event loop
+            query_embedding = await asyncio.get_running_loop().run_in_executor(
+                embedding_service.executor,
+                embedding_service.generate_query_embedding,
+                query
+            )
             
             if not query_embedding:
-                print("Failed to generate query embedding")
+                logger.warning("Failed to generate query embedding")
                 return []
             
-            # Get all embeddings for this project
             if not supabase_service.is_available():
-                print("Supabase not available")
+                logger.warning("Supabase not available")
                 return []
             
-            embeddings = await supabase_service.get_project_embeddings(project_id)
+            # Let pgvector rank the project's embeddings server-side
+            results = await supabase_service.match_code_embeddings(
+                project_id=project_id,
+                query_embedding=query_embedding,
+                top_k=top_k
+            )
             
-            if not embeddings:
-                print(f"No embeddings found for project {project_id}")
+            if results is not None:
+                self._query_cache.set(cache_key, results)
+                return results
+            
+            # Fall back to ranking the project's embedding matrix in Python
+            cached_matrix = self._project_matrix_cache.get(project_id)
+            if cached_matrix is None:
+                embeddings = await supabase_service.get_project_embeddings(project_id)
+                # The listing carries no vectors or code; fetch them for the matrix
+                vectors = await supabase_service.get_embedding_vectors(
+                    [emb['id'] for emb in embeddings],
+                    with_content=True
+                )
+                by_id = {row['id']: row for row in vectors}
+                embeddings = [{**emb, **by_id[emb['id']]} for emb in embeddings if emb['id'] in by_id]
+                cached_matrix = embedding_service.build_embedding_matrix(embeddings)
+                if cached_matrix[0]:
+                    self._project_matrix_cache.set(project_id, cached_matrix)
+            items, matrix = cached_matrix
+            
+            if not items:
+                logger.info("No embeddings found for project %s", project_id)
                 return []
             
             # Search for similar code
-            results = embedding_service.search_similar_code(
+            results = embedding_service.search_embedding_matrix(
                 query_embedding=query_embedding,
-                code_embeddings=embeddings,
+                items=items,
+                matrix=matrix,
                 top_k=top_k
             )
             
+            self._query_cache.set(cache_key, results)
             return results
             
         except Exception as e:
-            print(f"Error searching codebase: {e}")
+            logger.error("Error searching codebase: %s", e)
             return []
     
+    def clear_search_caches(self):
+        """Drop cached search results and project matrices after embeddings change or are deleted"""
+        self._query_cache.clear()
+        self._project_matrix_cache.clear()
+    
     def format_context_for_ai(self, search_results: List[Dict]) -> str:
         """
         Format search results into context for AI
@@ -182,44 +485,35 @@ class RAGService:
             language = result.get('language', 'unknown')
             code = result.get('code_content', '')
             
+            # Cite the chunk's line range when known
+            if result.get('start_line') and result.get('end_line'):
+                file_path = f"{file_path}:{result['start_line']}-{result['end_line']}"
+            
             context += f"### {i}. {file_path} (relevance: {similarity:.2%})\n"
             context += f"Language: {language}\n"
             context += f"```{language}\n{code}\n```\n\n"
         
         return context
     
-    async def get_rag_context(
-        self,
-        query: str,
-        project_id: str,
-        current_file_content: Optional[str] = None,
-        current_file_path: Optional[str] = None
-    ) -> str:
+    async def get_rag_context(self, query: str, project_id: str) -> str:
         """
         Get complete RAG context for AI query
+        The open file is not repeated here; the tutor prompt already
+        carries a window of it around the cursor
         
         Args:
             query: User's question
             project_id: Project ID
-            current_file_content: Content of currently open file
-            current_file_path: Path of currently open file
             
         Returns:
             Formatted context string
         """
-        context_parts = []
-        
-        # Add current file context
-        if current_file_content and current_file_path:
-            context_parts.append(f"## Current File: {current_file_path}\n```\n{current_file_content}\n```\n")
-        
         # Search codebase for relevant files
         search_results = await self.search_codebase(query, project_id, top_k=3)
         
-        if search_results:
-            context_parts.append(self.format_context_for_ai(search_results))
-        
-        return "\n".join(context_parts)
+        if not search_results:
+            return ""
+        return self.format_context_for_ai(search_results)
 
 # Global instance
 rag_service = RAGService()
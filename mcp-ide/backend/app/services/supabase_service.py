@@ -1,9 +1,38 @@
+import asyncio
+import logging
 import httpx
+import orjson
 from app.core.config import settings
+from app.core.cache import TTLCache
 from typing import Optional, Dict, List
 from datetime import datetime
 import uuid
 
+logger = logging.getLogger(__name__)
+
+# Rows per bulk upsert request
+EMBEDDING_BULK_CHUNK = 100
+
+# Content hashes per lookup request (keeps the URL short)
+HASH_LOOKUP_CHUNK = 50
+
+# Seconds project embedding listings and error lookups are cached
+LOOKUP_CACHE_TTL = 60.0
+
+# Columns returned by listing calls (vectors and code blobs are fetched separately)
+EMBEDDING_LIST_COLUMNS = "id,file_id,chunk_index,start_line,end_line,file_path,language,content_hash"
+MESSAGE_COLUMNS = "id,role,content,timestamp"
+CODE_HISTORY_COLUMNS = "id,file_path,language,errors,cursor_line,cursor_column,created_at"
+
+# Minimum cosine similarity for a semantic cache hit
+SEMANTIC_CACHE_THRESHOLD = 0.92
+
+# Seconds session updates are held so several can go out as one PATCH
+SESSION_FLUSH_DELAY = 0.05
+
+# Cache sentinel (None is a valid cached "no match")
+_MISSING = object()
+
 class SupabaseService:
     """
     Service for interacting with Supabase database via REST API
@@ -17,8 +46,58 @@ class SupabaseService:
             "apikey": self.api_key,
             "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json",
-            "Prefer": "return=representation"
+            # Writes only need success/failure; calls that want the row ask for it
+            "Prefer": "return=minimal"
         }
+        # One pooled HTTP/2 client reused by every call (no per-call TLS handshake)
+        self._client = httpx.AsyncClient(
+            base_url=f"{self.base_url}/rest/v1",
+            headers=self.headers,
+            http2=True,
+            timeout=10.0,
+            limits=httpx.Limits(
+                max_keepalive_connections=20,
+                max_connections=50
+            )
+        )
+    
+        # Per-project embedding listings (cleared on any embedding write)
+        # and per-language error lookups
+        self._proj_emb_cache = TTLCache(maxsize=256, ttl=LOOKUP_CACHE_TTL)
+        self._error_cache = TTLCache(maxsize=256, ttl=LOOKUP_CACHE_TTL)
+        
+        # Debounced tutor_sessions updates: fields waiting to be PATCHed and
+        # the task that will send them, per session
+        self._pending_session_updates: Dict[str, Dict] = {}
+        self._session_flush_tasks: Dict[str, asyncio.Task] = {}
+        # Messages saved per session since the last flush; added to
+        # message_count on the server, never written as an absolute value
+        self._pending_message_counts: Dict[str, int] = {}
+        # Set once PostgREST reports match_code_embeddings missing (migration
+        # not applied); searches then go straight to the Python fallback
+        self._match_rpc_missing = False
+    
+    async def aclose(self):
+        """Flush pending session updates and close the pooled HTTP client"""
+        if self._session_flush_tasks:
+            await asyncio.gather(*self._session_flush_tasks.values(), return_exceptions=True)
+        await self._client.aclose()
+    
+    async def _post_json(self, url: str, body, **kwargs) -> httpx.Response:
+        """POST a body serialized with orjson (numpy arrays go through as-is)"""
+        return await self._client.post(
+            url,
+            content=orjson.dumps(body, option=orjson.OPT_SERIALIZE_NUMPY),
+            **kwargs
+        )
+    
+    async def _patch_json(self, url: str, body, **kwargs) -> httpx.Response:
+        """PATCH a body serialized with orjson"""
+        return await self._client.patch(
+            url,
+            content=orjson.dumps(body, option=orjson.OPT_SERIALIZE_NUMPY),
+            **kwargs
+        )
     
     def is_available(self) -> bool:
         """Check if Supabase is configured"""
@@ -27,135 +106,382 @@ class SupabaseService:
     
     # ==================== CODE EMBEDDINGS (RAG) ====================
     
-    async def save_code_embedding(
-        self,
-        file_id: str,
-        file_path: str,
-        language: str,
-        code_content: str,
-        embedding: List[float],
-        content_hash: str
-    ) -> Optional[str]:
-        """Save or update code embedding for RAG (upsert)"""
+    async def save_code_embeddings_bulk(self, rows: List[Dict]) -> bool:
+        """
+        Save or update many code embeddings (upsert on file_id, chunk_index)
+        Rows are sent as JSON arrays, EMBEDDING_BULK_CHUNK rows per request
+        
+        Args:
+            rows: Dicts with file_id, chunk_index, start_line, end_line,
+                file_path, language, code_content, embedding, content_hash
+        """
         if not self.is_available():
-            print("⚠️ Supabase not available")
-            return None
+            logger.warning("⚠️ Supabase not available")
+            return False
+        
+        if not rows:
+            return True
+        
+        # A statement may not hit the same conflict key twice; keep the last row
+        rows = list({(row['file_id'], row.get('chunk_index', 0)): row for row in rows}.values())
         
         try:
-            # Check if embedding already exists for this file
-            async with httpx.AsyncClient() as client:
-                check_response = await client.get(
-                    f"{self.base_url}/rest/v1/code_embeddings",
-                    headers=self.headers,
-                    params={"file_id": f"eq.{file_id}"},
+            for start in range(0, len(rows), EMBEDDING_BULK_CHUNK):
+                chunk = rows[start:start + EMBEDDING_BULK_CHUNK]
+                response = await self._post_json(
+                    "/code_embeddings",
+                    chunk,
+                    headers={"Prefer": "resolution=merge-duplicates,return=minimal"},
+                    params={"on_conflict": "file_id,chunk_index"},
                     timeout=30.0
                 )
                 
-                existing = check_response.json() if check_response.status_code == 200 else []
+                if response.status_code not in [200, 201, 204]:
+                    logger.error("❌ Failed to save embeddings: %s - %s", response.status_code, response.text)
+                    return False
+            
+            self._proj_emb_cache.clear()
+            logger.debug("✅ Saved %s embeddings", len(rows))
+            return True
                 
-                if existing:
-                    # Update existing embedding
-                    embedding_id = existing[0]['id']
-                    data = {
-                        "file_path": file_path,
-                        "language": language,
-                        "code_content": code_content,
-                        "embedding": embedding,
-                        "content_hash": content_hash
-                    }
-                    
-                    response = await client.patch(
-                        f"{self.base_url}/rest/v1/code_embeddings?id=eq.{embedding_id}",
-                        headers=self.headers,
-                        json=data,
-                        timeout=30.0
-                    )
-                    
-                    if response.status_code in [200, 204]:
-                        print(f"✅ Updated embedding for: {file_path}")
-                        return embedding_id
-                    else:
-                        print(f"❌ Failed to update embedding: {response.status_code} - {response.text}")
-                        return None
-                else:
-                    # Create new embedding
-                    embedding_id = str(uuid.uuid4())
-                    data = {
-                        "id": embedding_id,
-                        "file_id": file_id,
-                        "file_path": file_path,
-                        "language": language,
-                        "code_content": code_content,
-                        "embedding": embedding,
-                        "content_hash": content_hash
-                    }
-                    
-                    response = await client.post(
-                        f"{self.base_url}/rest/v1/code_embeddings",
-                        headers=self.headers,
-                        json=data,
-                        timeout=30.0
-                    )
+        except Exception as e:
+            logger.error("❌ Error saving embeddings: %s", e)
+            return False
+    
+    async def get_embeddings_by_hash(self, content_hashes: List[str]) -> Dict[str, List[List[float]]]:
+        """
+        Look up stored chunk vectors for content hashes (across all files)
+        Lets identical content be indexed without running the model again
+        
+        Returns:
+            Dict of content_hash -> chunk embeddings (in chunk order) for the
+            hashes that were found
+        """
+        if not self.is_available() or not content_hashes:
+            return {}
+        
+        found = {}
+        try:
+            for start in range(0, len(content_hashes), HASH_LOOKUP_CHUNK):
+                chunk = content_hashes[start:start + HASH_LOOKUP_CHUNK]
+                response = await self._client.get(
+                    "/code_embeddings",
+                    params={
+                        "content_hash": f"in.({','.join(chunk)})",
+                        "select": "content_hash,file_id,chunk_index,embedding",
+                        "order": "chunk_index.asc"
+                    },
+                    timeout=30.0
+                )
+                
+                if response.status_code != 200:
+                    continue
+                
+                # Several files may share a hash; take the chunks of one of them
+                source_files = {}
+                for row in orjson.loads(response.content):
+                    content_hash = row['content_hash']
+                    if source_files.setdefault(content_hash, row['file_id']) != row['file_id']:
+                        continue
                     
-                    if response.status_code in [200, 201]:
-                        print(f"✅ Created embedding for: {file_path}")
-                        return embedding_id
-                    else:
-                        print(f"❌ Failed to create embedding: {response.status_code} - {response.text}")
-                        return None
+                    embedding = row.get('embedding')
+                    # pgvector columns come back as "[0.1,0.2,...]" strings
+                    if isinstance(embedding, str):
+                        embedding = orjson.loads(embedding)
+                    if embedding:
+                        found.setdefault(content_hash, []).append(embedding)
+        
+            return found
                     
         except Exception as e:
-            print(f"❌ Error saving embedding: {e}")
-            import traceback
-            traceback.print_exc()
-            return None
+            logger.error("Error looking up embeddings by hash: %s", e)
+            return found
+    
+    async def delete_code_embeddings(self, file_ids: List[str]) -> bool:
+        """Delete all stored chunk embeddings of the given files"""
+        if not self.is_available():
+            return False
+        
+        if not file_ids:
+            return True
+        
+        try:
+            response = await self._client.delete(
+                "/code_embeddings",
+                params={"file_id": f"in.({','.join(file_ids)})"},
+                timeout=30.0
+            )
+            self._proj_emb_cache.clear()
+            
+            return response.status_code in [200, 204]
+                
+        except Exception as e:
+            logger.error("Error deleting embeddings: %s", e)
+            return False
+    
+    async def delete_stale_chunks(self, chunk_counts: Dict[str, int]) -> bool:
+        """
+        Delete chunks past the new end of re-embedded files
+        
+        Args:
+            chunk_counts: Dict of file_id -> number of chunks just stored
+        """
+        if not self.is_available():
+            return False
+        
+        # One request per distinct chunk count
+        by_count: Dict[int, List[str]] = {}
+        for file_id, count in chunk_counts.items():
+            by_count.setdefault(count, []).append(file_id)
+        
+        try:
+            ok = True
+            for count, file_ids in by_count.items():
+                response = await self._client.delete(
+                    "/code_embeddings",
+                    params={
+                        "file_id": f"in.({','.join(file_ids)})",
+                        "chunk_index": f"gte.{count}"
+                    },
+                    timeout=30.0
+                )
+                ok = ok and response.status_code in [200, 204]
+            self._proj_emb_cache.clear()
+            
+            return ok
+                
+        except Exception as e:
+            logger.error("Error deleting stale chunks: %s", e)
+            return False
     
     async def get_project_embeddings(self, project_id: str) -> List[Dict]:
-        """Get all embeddings for a project"""
+        """Get all embedding rows for a project (metadata only, no vectors or code)"""
         if not self.is_available():
             return []
         
+        cached = self._proj_emb_cache.get(project_id)
+        if cached is not None:
+            return cached
+        
         try:
             # First get all file IDs for this project
-            async with httpx.AsyncClient() as client:
-                files_response = await client.get(
-                    f"{self.base_url}/rest/v1/files",
-                    headers=self.headers,
-                    params={"project_id": f"eq.{project_id}", "select": "id"},
+            files_response = await self._client.get(
+                "/files",
+                params={"project_id": f"eq.{project_id}", "select": "id"},
+                timeout=30.0
+            )
+            
+            if files_response.status_code != 200:
+                return []
+            
+            file_ids = [f['id'] for f in orjson.loads(files_response.content)]
+            
+            if not file_ids:
+                return []
+            
+            # Get embeddings for these files
+            embeddings_response = await self._client.get(
+                "/code_embeddings",
+                params={
+                    "file_id": f"in.({','.join(file_ids)})",
+                    "select": EMBEDDING_LIST_COLUMNS
+                },
+                timeout=30.0
+            )
+            
+            if embeddings_response.status_code == 200:
+                embeddings = orjson.loads(embeddings_response.content)
+                self._proj_emb_cache.set(project_id, embeddings)
+                return embeddings
+            else:
+                return []
+                
+        except Exception as e:
+            logger.error("Error getting project embeddings: %s", e)
+            return []
+    
+    async def get_embedding_vectors(self, ids: List[str], with_content: bool = False) -> List[Dict]:
+        """
+        Fetch stored vectors for embedding rows
+        
+        Args:
+            ids: code_embeddings row IDs
+            with_content: Also return each row's code_content
+            
+        Returns:
+            Rows with id, embedding (and code_content)
+        """
+        if not self.is_available() or not ids:
+            return []
+        
+        columns = "id,embedding,code_content" if with_content else "id,embedding"
+        rows = []
+        try:
+            for start in range(0, len(ids), HASH_LOOKUP_CHUNK):
+                chunk = ids[start:start + HASH_LOOKUP_CHUNK]
+                response = await self._client.get(
+                    "/code_embeddings",
+                    params={"id": f"in.({','.join(chunk)})", "select": columns},
                     timeout=30.0
                 )
                 
-                if files_response.status_code != 200:
-                    return []
+                if response.status_code == 200:
+                    rows.extend(orjson.loads(response.content))
+            
+            return rows
                 
-                file_ids = [f['id'] for f in files_response.json()]
+        except Exception as e:
+            logger.error("Error getting embedding vectors: %s", e)
+            return rows
+    
+    async def match_code_embeddings(
+        self,
+        project_id: str,
+        query_embedding: List[float],
+        top_k: int = 3
+    ) -> Optional[List[Dict]]:
+        """
+        Top-k cosine search over a project's embeddings, done by pgvector
+        
+        Returns:
+            Matching rows with similarity, or None if the RPC is unavailable
+        """
+        if not self.is_available() or self._match_rpc_missing:
+            return None
+        
+        try:
+            response = await self._post_json(
+                "/rpc/match_code_embeddings",
+                {"p_project": project_id, "p_query": query_embedding, "p_k": top_k},
+                timeout=30.0
+            )
+            
+            if response.status_code == 200:
+                return orjson.loads(response.content)
+            
+            if response.status_code == 404:
+                self._match_rpc_missing = True
+                logger.warning("⚠️ match_code_embeddings RPC not found; using in-process search")
+                return None
+            
+            logger.error("match_code_embeddings failed: %s - %s", response.status_code, response.text)
+            return None
                 
-                if not file_ids:
-                    return []
+        except Exception as e:
+            logger.error("Error matching code embeddings: %s", e)
+            return None
+    
+    async def claim_embedding_jobs(self, limit: int = 16) -> Optional[List[Dict]]:
+        """
+        Lease up to limit queued jobs (FOR UPDATE SKIP LOCKED)
+        Leased jobs stay queued until complete_embedding_jobs is called;
+        a lease that is never completed expires and the job is claimed again
+        
+        Returns:
+            Files to embed (id, path, language, content, embedded_hash),
+            or None if the RPC is unavailable
+        """
+        if not self.is_available():
+            return None
+        
+        try:
+            response = await self._post_json(
+                "/rpc/claim_embedding_jobs",
+                {"p_limit": limit},
+                timeout=30.0
+            )
+            
+            if response.status_code == 200:
+                return orjson.loads(response.content)
+            
+            logger.error("claim_embedding_jobs failed: %s - %s", response.status_code, response.text)
+            return None
                 
-                # Get embeddings for these files
-                embeddings_response = await client.get(
-                    f"{self.base_url}/rest/v1/code_embeddings",
-                    headers=self.headers,
-                    params={"file_id": f"in.({','.join(file_ids)})"},
-                    timeout=30.0
-                )
+        except Exception as e:
+            logger.error("Error claiming embedding jobs: %s", e)
+            return None
+    
+    async def complete_embedding_jobs(self, done: List[str], failed: List[str]) -> bool:
+        """
+        Finish leased jobs: remove the done ones, release the failed ones
+        so the next claim retries them
+        """
+        if not self.is_available():
+            return False
+        
+        if not done and not failed:
+            return True
+        
+        try:
+            response = await self._post_json(
+                "/rpc/complete_embedding_jobs",
+                {"p_done": done, "p_failed": failed},
+                timeout=30.0
+            )
+            
+            if response.status_code in [200, 204]:
+                return True
+            
+            logger.error("complete_embedding_jobs failed: %s - %s", response.status_code, response.text)
+            return False
                 
-                if embeddings_response.status_code == 200:
-                    return embeddings_response.json()
-                else:
-                    return []
-                    
         except Exception as e:
-            print(f"Error getting project embeddings: {e}")
-            return []
+            logger.error("Error completing embedding jobs: %s", e)
+            return False
+    
+    # ==================== SEMANTIC QUERY CACHE ====================
+    
+    async def semantic_cache_lookup(
+        self,
+        embedding: List[float],
+        workspace: str,
+        threshold: float = SEMANTIC_CACHE_THRESHOLD
+    ) -> Optional[Dict]:
+        """
+        Find a cached answer to a near-duplicate question in the same workspace
+        
+        Returns:
+            The cached response dict, or None on a miss
+        """
+        if not self.is_available():
+            return None
+        
+        try:
+            response = await self._post_json(
+                "/rpc/match_cached_query",
+                {"p_query": embedding, "p_threshold": threshold, "p_workspace": workspace}
+            )
+            
+            if response.status_code == 200:
+                data = orjson.loads(response.content)
+                return data[0]['response'] if data else None
+            return None
+        except Exception as e:
+            logger.error("Error looking up semantic cache: %s", e)
+            return None
+    
+    async def semantic_cache_put(self, embedding: List[float], response: Dict, workspace: str) -> bool:
+        """Cache an answer for a question embedding (expires after 24 hours, expired entries are purged)"""
+        if not self.is_available():
+            return False
+        
+        try:
+            result = await self._post_json(
+                "/rpc/put_cached_query",
+                {"p_workspace": workspace, "p_query": embedding, "p_response": response}
+            )
+            
+            return result.status_code in [200, 201, 204]
+        except Exception as e:
+            logger.error("Error writing semantic cache: %s", e)
+            return False
     
     # ==================== SESSIONS ====================
     
     async def create_session(self, user_id: Optional[str] = None, language: str = "javascript", file_path: str = "main.js") -> Optional[str]:
         """Create a new tutor session"""
         if not self.is_available():
-            print("❌ Supabase not available - check SUPABASE_URL and SUPABASE_KEY")
+            logger.warning("❌ Supabase not available - check SUPABASE_URL and SUPABASE_KEY")
             return None
         
         try:
@@ -170,30 +496,23 @@ class SupabaseService:
                 "message_count": 0
             }
             
-            print(f"Creating session with ID: {session_id}")
-            print(f"URL: {self.base_url}/rest/v1/tutor_sessions")
+            logger.debug("Creating session with ID: %s", session_id)
             
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    f"{self.base_url}/rest/v1/tutor_sessions",
-                    headers=self.headers,
-                    json=data,
-                    timeout=10.0
-                )
-                
-                print(f"Session creation response: {response.status_code}")
-                print(f"Response body: {response.text}")
-                
-                if response.status_code in [200, 201]:
-                    print(f"✅ Session created successfully: {session_id}")
-                    return session_id
-                else:
-                    print(f"❌ Error creating session: {response.status_code} - {response.text}")
-                    return None
+            response = await self._post_json(
+                "/tutor_sessions",
+                data
+            )
+            
+            logger.debug("Session creation response: %s", response.status_code)
+            
+            if response.status_code in [200, 201, 204]:
+                logger.debug("✅ Session created successfully: %s", session_id)
+                return session_id
+            else:
+                logger.error("❌ Error creating session: %s - %s", response.status_code, response.text)
+                return None
         except Exception as e:
-            print(f"❌ Exception creating session: {e}")
-            import traceback
-            traceback.print_exc()
+            logger.exception("❌ Exception creating session: %s", e)
             return None
     
     async def end_session(self, session_id: str):
@@ -201,42 +520,61 @@ class SupabaseService:
         if not self.is_available():
             return
         
-        try:
-            data = {
-                "ended_at": datetime.utcnow().isoformat()
-            }
-            
-            async with httpx.AsyncClient() as client:
-                await client.patch(
-                    f"{self.base_url}/rest/v1/tutor_sessions?id=eq.{session_id}",
-                    headers=self.headers,
-                    json=data,
-                    timeout=10.0
-                )
-        except Exception as e:
-            print(f"Error ending session: {e}")
+        self._queue_session_update(session_id, {
+            "ended_at": datetime.utcnow().isoformat()
+        })
     
     async def update_session_context(self, session_id: str, language: str, file_path: str):
         """Update session language and file path"""
         if not self.is_available():
             return
         
-        try:
-            data = {
-                "language": language,
-                "file_path": file_path
-            }
-            
-            async with httpx.AsyncClient() as client:
-                await client.patch(
-                    f"{self.base_url}/rest/v1/tutor_sessions?id=eq.{session_id}",
-                    headers=self.headers,
-                    json=data,
-                    timeout=10.0
-                )
-                print(f"✅ Session context updated: {language} - {file_path}")
-        except Exception as e:
-            print(f"Error updating session context: {e}")
+        self._queue_session_update(session_id, {
+            "language": language,
+            "file_path": file_path
+        })
+    
+    def _count_messages(self, session_id: str, count: int):
+        """Queue count saved messages to be added to the session's message_count"""
+        self._pending_message_counts[session_id] = self._pending_message_counts.get(session_id, 0) + count
+        self._queue_session_update(session_id, {})
+    
+    def _queue_session_update(self, session_id: str, fields: Dict):
+        """
+        Merge fields into the session's pending update
+        Updates arriving within SESSION_FLUSH_DELAY go out together
+        """
+        pending = self._pending_session_updates.setdefault(session_id, {})
+        pending.update(fields)
+        
+        if session_id not in self._session_flush_tasks:
+            self._session_flush_tasks[session_id] = asyncio.create_task(
+                self._flush_session_update(session_id)
+            )
+    
+    async def _flush_session_update(self, session_id: str):
+        """Send a session's pending fields in one PATCH and its new messages in one increment"""
+        await asyncio.sleep(SESSION_FLUSH_DELAY)
+        self._session_flush_tasks.pop(session_id, None)
+        data = self._pending_session_updates.pop(session_id, {})
+        message_count = self._pending_message_counts.pop(session_id, 0)
+        
+        requests = []
+        if data:
+            requests.append(self._patch_json(f"/tutor_sessions?id=eq.{session_id}", data))
+        if message_count:
+            requests.append(self._post_json(
+                "/rpc/add_session_messages",
+                {"p_session": session_id, "p_count": message_count}
+            ))
+        
+        for response in await asyncio.gather(*requests, return_exceptions=True):
+            if isinstance(response, Exception):
+                logger.error("Error updating session: %s", response)
+            elif response.status_code not in [200, 204]:
+                logger.error("❌ Error updating session %s: %s - %s", session_id, response.status_code, response.text)
+            else:
+                logger.debug("✅ Session updated: %s", session_id)
     
     # ==================== MESSAGES ====================
     
@@ -264,30 +602,22 @@ class SupabaseService:
                 "timestamp": datetime.utcnow().isoformat()
             }
             
-            print(f"Attempting to save message...")
-            print(f"Data: {data}")
+            response = await self._post_json(
+                "/tutor_messages",
+                data
+            )
             
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    f"{self.base_url}/rest/v1/tutor_messages",
-                    headers=self.headers,
-                    json=data,
-                    timeout=10.0
-                )
-                
-                print(f"Message save response: {response.status_code}")
-                print(f"Response body: {response.text}")
-                
-                if response.status_code in [200, 201]:
-                    print(f"✅ Message saved successfully: {message_id}")
-                    return message_id
-                else:
-                    print(f"❌ Error saving message: {response.status_code} - {response.text}")
-                    return None
+            logger.debug("Message save response: %s", response.status_code)
+            
+            if response.status_code in [200, 201, 204]:
+                logger.debug("✅ Message saved successfully: %s", message_id)
+                self._count_messages(session_id, 1)
+                return message_id
+            else:
+                logger.error("❌ Error saving message: %s - %s", response.status_code, response.text)
+                return None
         except Exception as e:
-            print(f"❌ Exception saving message: {e}")
-            import traceback
-            traceback.print_exc()
+            logger.exception("❌ Exception saving message: %s", e)
             return None
     
     async def get_session_messages(self, session_id: str, limit: int = 50) -> List[Dict]:
@@ -296,18 +626,13 @@ class SupabaseService:
             return []
         
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.get(
-                    f"{self.base_url}/rest/v1/tutor_messages?session_id=eq.{session_id}&order=timestamp.asc&limit={limit}",
-                    headers=self.headers,
-                    timeout=10.0
-                )
-                
-                if response.status_code == 200:
-                    return response.json()
-                return []
+            response = await self._client.get(f"/tutor_messages?session_id=eq.{session_id}&order=timestamp.asc&limit={limit}&select={MESSAGE_COLUMNS}")
+            
+            if response.status_code == 200:
+                return orjson.loads(response.content)
+            return []
         except Exception as e:
-            print(f"Error getting messages: {e}")
+            logger.error("Error getting messages: %s", e)
             return []
     
     # ==================== CODE HISTORY ====================
@@ -324,7 +649,7 @@ class SupabaseService:
     ) -> Optional[str]:
         """Save a code snapshot with execution results"""
         if not self.is_available():
-            print("Supabase not available - check SUPABASE_URL and SUPABASE_KEY in .env")
+            logger.warning("Supabase not available - check SUPABASE_URL and SUPABASE_KEY in .env")
             return None
         
         try:
@@ -346,55 +671,42 @@ class SupabaseService:
                 "cursor_column": 1
             }
             
-            print(f"Attempting to save code snapshot to Supabase...")
-            print(f"URL: {self.base_url}/rest/v1/code_history")
-            print(f"Data: {data}")
+            response = await self._post_json(
+                "/code_history",
+                data
+            )
             
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    f"{self.base_url}/rest/v1/code_history",
-                    headers=self.headers,
-                    json=data,
-                    timeout=10.0
-                )
-                
-                print(f"Response status: {response.status_code}")
-                print(f"Response body: {response.text}")
-                
-                if response.status_code in [200, 201]:
-                    print(f"✅ Code snapshot saved successfully: {snapshot_id}")
-                    return snapshot_id
-                else:
-                    print(f"❌ Error saving code snapshot: {response.status_code} - {response.text}")
-                    return None
+            logger.debug("Code snapshot save response: %s", response.status_code)
+            
+            if response.status_code in [200, 201, 204]:
+                logger.debug("✅ Code snapshot saved successfully: %s", snapshot_id)
+                return snapshot_id
+            else:
+                logger.error("❌ Error saving code snapshot: %s - %s", response.status_code, response.text)
+                return None
         except Exception as e:
-            print(f"❌ Exception saving code snapshot: {e}")
-            import traceback
-            traceback.print_exc()
+            logger.exception("❌ Exception saving code snapshot: %s", e)
             return None
     
     async def get_code_history(
         self,
         session_id: str,
-        limit: int = 20
+        limit: int = 20,
+        include_code: bool = False
     ) -> List[Dict]:
-        """Get code history for a session"""
+        """Get code history for a session (code_content only if include_code)"""
         if not self.is_available():
             return []
         
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.get(
-                    f"{self.base_url}/rest/v1/code_history?session_id=eq.{session_id}&order=timestamp.desc&limit={limit}",
-                    headers=self.headers,
-                    timeout=10.0
-                )
-                
-                if response.status_code == 200:
-                    return response.json()
-                return []
+            columns = CODE_HISTORY_COLUMNS + (",code_content" if include_code else "")
+            response = await self._client.get(f"/code_history?session_id=eq.{session_id}&order=timestamp.desc&limit={limit}&select={columns}")
+            
+            if response.status_code == 200:
+                return orjson.loads(response.content)
+            return []
         except Exception as e:
-            print(f"Error getting code history: {e}")
+            logger.error("Error getting code history: %s", e)
             return []
     
     # ==================== COMMON ERRORS ====================
@@ -404,20 +716,22 @@ class SupabaseService:
         if not self.is_available():
             return None
         
+        # The lookup only filters on language, so that is the cache key
+        cached = self._error_cache.get(language, _MISSING)
+        if cached is not _MISSING:
+            return cached
+        
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.get(
-                    f"{self.base_url}/rest/v1/common_errors?language=eq.{language}&limit=5",
-                    headers=self.headers,
-                    timeout=10.0
-                )
-                
-                if response.status_code == 200:
-                    data = response.json()
-                    return data[0] if data else None
-                return None
+            response = await self._client.get(f"/common_errors?language=eq.{language}&limit=5")
+            
+            if response.status_code == 200:
+                data = orjson.loads(response.content)
+                match = data[0] if data else None
+                self._error_cache.set(language, match)
+                return match
+            return None
         except Exception as e:
-            print(f"Error finding similar error: {e}")
+            logger.error("Error finding similar error: %s", e)
             return None
     
     async def log_error_pattern(
@@ -444,15 +758,13 @@ class SupabaseService:
                 "created_at": datetime.utcnow().isoformat()
             }
             
-            async with httpx.AsyncClient() as client:
-                await client.post(
-                    f"{self.base_url}/rest/v1/common_errors",
-                    headers=self.headers,
-                    json=data,
-                    timeout=10.0
-                )
+            await self._post_json(
+                "/common_errors",
+                data
+            )
+            self._error_cache.pop(language)
         except Exception as e:
-            print(f"Error logging error pattern: {e}")
+            logger.error("Error logging error pattern: %s", e)
 
 # Global instance
 supabase_service = SupabaseService()
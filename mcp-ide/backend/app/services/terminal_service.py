@@ -1,53 +1,176 @@
 import asyncio
-import subprocess
+import codecs
+import hashlib
 import os
-from typing import Optional, Dict, List
+import shlex
+import shutil
+from collections import OrderedDict, deque
+from typing import Callable, Optional, Dict, List, Tuple
 import uuid
 
+# Executables a terminal session may launch (commands run without a shell)
+# (npx is left out: it downloads and runs arbitrary packages)
+ALLOWED_EXECUTABLES = {"npm", "node", "python", "pytest", "ls", "cat"}
+
+# Open sessions kept before the least recently used one is closed
+MAX_SESSIONS = 200
+
+# Commands remembered per session
+MAX_HISTORY = 500
+
+# Characters of stdout/stderr kept per history entry (the tail is kept)
+MAX_OUTPUT_CHARS = 64 * 1024
+
+# Bytes of each output stream kept in memory while a command runs (the tail)
+MAX_STREAM_BYTES = 256 * 1024
+
+# Bytes read from a pipe per chunk
+STREAM_READ_SIZE = 4096
+
+# Receives (stream, text) as output arrives; stream is "output" or "error"
+ChunkCallback = Callable[[str, str], None]
+
+def _truncate_output(text: str) -> str:
+    """Keep only the last MAX_OUTPUT_CHARS characters of command output"""
+    if len(text) > MAX_OUTPUT_CHARS:
+        return "...[truncated]..." + text[-MAX_OUTPUT_CHARS:]
+    return text
+
 class TerminalSession:
     """Represents a terminal session"""
     
-    def __init__(self, session_id: str, working_dir: str):
+    def __init__(
+        self,
+        session_id: str,
+        working_dir: str,
+        slots: Optional[asyncio.Semaphore] = None
+    ):
         self.session_id = session_id
         self.working_dir = working_dir
-        self.process: Optional[subprocess.Popen] = None
-        self.history: List[Dict] = []
+        # One command at a time per session; slots caps processes service-wide
+        self._lock = asyncio.Lock()
+        self._slots = slots
+        self.process: Optional[asyncio.subprocess.Process] = None
+        self.history: deque = deque(maxlen=MAX_HISTORY)
     
-    async def execute_command(self, command: str) -> Dict:
+    async def execute_command(self, command: str, on_chunk: Optional[ChunkCallback] = None) -> Dict:
         """Execute a command and return output"""
         try:
-            # Security: Block dangerous commands
-            dangerous_commands = ['rm -rf', 'format', 'del /f', 'shutdown', 'reboot']
-            if any(cmd in command.lower() for cmd in dangerous_commands):
-                return {
-                    "output": "",
-                    "error": "Command blocked for security reasons",
-                    "exit_code": 1
-                }
+            argv = shlex.split(command)
+        except ValueError as e:
+            return {
+                "output": "",
+                "error": f"Could not parse command: {e}",
+                "exit_code": 1
+            }
+        
+        # Security: only allowlisted programs, and no shell to interpret
+        # pipes, redirects or substitutions. argv[0] must be the bare name:
+        # a path (./node, /tmp/x/cat) could point at any workspace file
+        if not argv or argv[0] not in ALLOWED_EXECUTABLES:
+            return {
+                "output": "",
+                "error": "Command not allowed. Allowed: " + ", ".join(sorted(ALLOWED_EXECUTABLES)),
+                "exit_code": 1
+            }
+        
+        # Run what PATH resolves the name to, never a file in the workspace
+        executable = shutil.which(argv[0])
+        if not executable:
+            return {
+                "output": "",
+                "error": f"Command not found: {argv[0]}",
+                "exit_code": 127
+            }
+        
+        return await self._exec_argv([executable, *argv[1:]], command, on_chunk)
+    
+    async def _exec_argv(
+        self,
+        argv: List[str],
+        command: Optional[str] = None,
+        on_chunk: Optional[ChunkCallback] = None
+    ) -> Dict:
+        """Run a program once this session and a service-wide slot are free"""
+        async with self._lock:
+            if self._slots is None:
+                return await self._spawn(argv, command, on_chunk)
+            async with self._slots:
+                return await self._spawn(argv, command, on_chunk)
+    
+    @staticmethod
+    async def _pump(
+        reader: asyncio.StreamReader,
+        stream: str,
+        buffer: bytearray,
+        on_chunk: Optional[ChunkCallback]
+    ):
+        """Read a pipe to EOF, forwarding chunks and keeping a bounded tail"""
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        while True:
+            chunk = await reader.read(STREAM_READ_SIZE)
+            if not chunk:
+                break
             
-            # Execute command
-            process = await asyncio.create_subprocess_shell(
-                command,
+            buffer += chunk
+            if len(buffer) > MAX_STREAM_BYTES:
+                del buffer[:len(buffer) - MAX_STREAM_BYTES]
+            
+            if on_chunk:
+                text = decoder.decode(chunk)
+                if text:
+                    on_chunk(stream, text)
+    
+    async def _spawn(
+        self,
+        argv: List[str],
+        command: Optional[str] = None,
+        on_chunk: Optional[ChunkCallback] = None
+    ) -> Dict:
+        """Run a program directly (no shell) and return its output"""
+        try:
+            # Resolve npm/npx to npm.cmd/npx.cmd on Windows
+            executable = shutil.which(argv[0]) or argv[0]
+            process = await asyncio.create_subprocess_exec(
+                executable,
+                *argv[1:],
                 stdout=asyncio.subprocess.PIPE,
                 stderr=asyncio.subprocess.PIPE,
-                cwd=self.working_dir,
-                shell=True
+                cwd=self.working_dir
             )
+            self.process = process
             
-            stdout, stderr = await asyncio.wait_for(
-                process.communicate(),
-                timeout=30.0  # 30 second timeout
-            )
+            # Read both pipes as output arrives instead of buffering it all
+            stdout, stderr = bytearray(), bytearray()
+            try:
+                await asyncio.wait_for(
+                    asyncio.gather(
+                        self._pump(process.stdout, "output", stdout, on_chunk),
+                        self._pump(process.stderr, "error", stderr, on_chunk),
+                        process.wait()
+                    ),
+                    timeout=30.0  # 30 second timeout
+                )
+            except (asyncio.TimeoutError, asyncio.CancelledError):
+                try:
+                    process.kill()
+                except ProcessLookupError:
+                    # Already exited
+                    pass
+                await process.wait()
+                raise
+            finally:
+                self.process = None
             
             result = {
-                "output": stdout.decode('utf-8', errors='replace'),
-                "error": stderr.decode('utf-8', errors='replace'),
+                "output": _truncate_output(stdout.decode('utf-8', errors='replace')),
+                "error": _truncate_output(stderr.decode('utf-8', errors='replace')),
                 "exit_code": process.returncode or 0
             }
             
             # Add to history
             self.history.append({
-                "command": command,
+                "command": command or shlex.join(argv),
                 "result": result
             })
             
@@ -59,6 +182,12 @@ class TerminalSession:
                 "error": "Command timed out (30 seconds)",
                 "exit_code": 124
             }
+        except FileNotFoundError:
+            return {
+                "output": "",
+                "error": f"Command not found: {argv[0]}",
+                "exit_code": 127
+            }
         except Exception as e:
             return {
                 "output": "",
@@ -66,6 +195,14 @@ class TerminalSession:
                 "exit_code": 1
             }
 
+    def close(self):
+        """Kill the running command, if any"""
+        if self.process and self.process.returncode is None:
+            try:
+                self.process.kill()
+            except ProcessLookupError:
+                pass
+
 class TerminalService:
     """
     Service for managing terminal sessions
@@ -73,8 +210,14 @@ class TerminalService:
     """
     
     def __init__(self):
-        self.sessions: Dict[str, TerminalSession] = {}
+        # LRU order: least recently used session first
+        self.sessions: "OrderedDict[str, TerminalSession]" = OrderedDict()
         self.base_workspace = os.path.join(os.getcwd(), "workspaces")
+        # Caps subprocesses across all sessions
+        self._global_sem = asyncio.Semaphore((os.cpu_count() or 1) * 2)
+        # Files last synced into each workspace directory (shared by its sessions):
+        # relative path -> (sha256, mtime_ns, size) as written
+        self.workspace_files: Dict[str, Dict[str, Tuple[str, int, int]]] = {}
         
         # Create workspaces directory
         os.makedirs(self.base_workspace, exist_ok=True)
@@ -87,16 +230,28 @@ class TerminalService:
         workspace_dir = os.path.join(self.base_workspace, project_id)
         os.makedirs(workspace_dir, exist_ok=True)
         
-        session = TerminalSession(session_id, workspace_dir)
+        session = TerminalSession(session_id, workspace_dir, self._global_sem)
         self.sessions[session_id] = session
         
+        while len(self.sessions) > MAX_SESSIONS:
+            _, evicted = self.sessions.popitem(last=False)
+            evicted.close()
+        
         return session_id
     
     def get_session(self, session_id: str) -> Optional[TerminalSession]:
         """Get an existing session"""
-        return self.sessions.get(session_id)
+        session = self.sessions.get(session_id)
+        if session:
+            self.sessions.move_to_end(session_id)
+        return session
     
-    async def execute_command(self, session_id: str, command: str) -> Dict:
+    async def execute_command(
+        self,
+        session_id: str,
+        command: str,
+        on_chunk: Optional[ChunkCallback] = None
+    ) -> Dict:
         """Execute a command in a session"""
         session = self.get_session(session_id)
         
@@ -107,43 +262,108 @@ class TerminalService:
                 "exit_code": 1
             }
         
-        return await session.execute_command(command)
+        return await session.execute_command(command, on_chunk)
+    
+    async def run(self, session_id: str, argv: List[str]) -> Dict:
+        """Run a fixed argv in a session (no shell, no allowlist parsing)"""
+        session = self.get_session(session_id)
+        
+        if not session:
+            return {
+                "output": "",
+                "error": "Session not found",
+                "exit_code": 1
+            }
+        
+        return await session._exec_argv(argv)
     
     def get_history(self, session_id: str) -> List[Dict]:
         """Get command history for a session"""
         session = self.get_session(session_id)
-        return session.history if session else []
+        return list(session.history) if session else []
     
     def close_session(self, session_id: str):
         """Close a terminal session"""
-        if session_id in self.sessions:
-            del self.sessions[session_id]
+        session = self.sessions.pop(session_id, None)
+        if session:
+            session.close()
     
     async def npm_install(self, session_id: str, package: Optional[str] = None) -> Dict:
         """Run npm install"""
-        command = f"npm install {package}" if package else "npm install"
-        return await self.execute_command(session_id, command)
+        argv = ["npm", "install", package] if package else ["npm", "install"]
+        return await self.run(session_id, argv)
     
     async def npm_run(self, session_id: str, script: str) -> Dict:
         """Run npm script"""
-        command = f"npm run {script}"
-        return await self.execute_command(session_id, command)
+        return await self.run(session_id, ["npm", "run", script])
     
-    def sync_files_to_workspace(self, session_id: str, files: Dict[str, str]):
-        """Sync files from database to workspace"""
+    async def sync_files_to_workspace(self, session_id: str, files: Dict[str, str]):
+        """
+        Sync files from database to workspace, skipping unchanged files
+        A file is skipped when it was last synced with the same content
+        and has not been modified on disk since
+        """
         session = self.get_session(session_id)
         if not session:
             return
         
-        for file_path, content in files.items():
-            full_path = os.path.join(session.working_dir, file_path)
-            
-            # Create directories if needed
-            os.makedirs(os.path.dirname(full_path), exist_ok=True)
-            
-            # Write file
-            with open(full_path, 'w', encoding='utf-8') as f:
-                f.write(content)
+        synced = self.workspace_files.setdefault(session.working_dir, {})
+        candidates = [
+            (
+                file_path,
+                os.path.join(session.working_dir, file_path),
+                content,
+                hashlib.sha256(content.encode('utf-8')).hexdigest()
+            )
+            for file_path, content in files.items()
+        ]
+        pending = await asyncio.to_thread(self._changed_files, candidates, synced)
+        
+        if not pending:
+            return
+        
+        # Create each directory once, then write the files concurrently
+        dirs = {os.path.dirname(full_path) for _, full_path, _, _ in pending}
+        await asyncio.to_thread(self._make_dirs, dirs)
+        
+        written = await asyncio.gather(*(
+            asyncio.to_thread(self._write_file, full_path, content)
+            for _, full_path, content, _ in pending
+        ))
+        
+        for (file_path, _, _, digest), (mtime_ns, size) in zip(pending, written):
+            synced[file_path] = (digest, mtime_ns, size)
+    
+    @staticmethod
+    def _changed_files(candidates, synced):
+        """Files whose content or on-disk copy differs from the last sync (blocking; run in a thread)"""
+        pending = []
+        for candidate in candidates:
+            file_path, full_path, _, digest = candidate
+            recorded = synced.get(file_path)
+            if recorded and recorded[0] == digest:
+                try:
+                    stat = os.stat(full_path)
+                    if (stat.st_mtime_ns, stat.st_size) == recorded[1:]:
+                        continue
+                except OSError:
+                    pass
+            pending.append(candidate)
+        return pending
+    
+    @staticmethod
+    def _make_dirs(dirs):
+        """Create workspace directories (blocking; run in a thread)"""
+        for directory in dirs:
+            os.makedirs(directory, exist_ok=True)
+    
+    @staticmethod
+    def _write_file(full_path: str, content: str) -> Tuple[int, int]:
+        """Write one workspace file and return its (mtime_ns, size) (blocking; run in a thread)"""
+        with open(full_path, 'w', encoding='utf-8') as f:
+            f.write(content)
+        stat = os.stat(full_path)
+        return stat.st_mtime_ns, stat.st_size
 
 # Global instance
 terminal_service = TerminalService()
@@ -1,17 +1,127 @@
+import asyncio
+import hashlib
+import re
 import httpx
+import orjson
 import google.generativeai as genai
 from app.core.config import settings
+from app.core.cache import TTLCache
+from typing import AsyncIterator, List, Tuple
 from app.models.schemas import EditorState, TutorResponse
 
+# Tutor rules sent at the start of every prompt. Keep this free of
+# timestamps, IDs or anything else per-request: it is the cacheable prefix
+STATIC_SYSTEM_PROMPT = """You are a supportive Socratic Tutor helping students learn to code.
+
+PERSONALITY:
+- Encouraging and positive
+- Acknowledge correct work first
+- Guide through questions, not lectures
+- Celebrate progress and effort
+
+RULES:
+1. If code is correct: Say "Yes, that's correct!" then ask them to explain WHY it works
+2. If code has errors: Point out the error gently, then guide them to fix it
+3. Use questions to deepen understanding, not to test
+4. Keep responses under 100 words
+5. Be warm and supportive
+
+RESPONSE PATTERN:
+✅ Correct code: "Great job! Your output is correct. Can you explain how [specific part] works?"
+❌ Error: "I see an issue on line X. What do you think [variable/function] should be doing here?"
+❓ Question: "Good question! Let's think about [concept]. What happens when...?"
+
+HELPFUL FEATURES:
+- Suggest reviewing specific concepts when stuck
+- Offer hints before full explanations
+- Connect to real-world examples
+- Encourage experimentation
+
+Remember: You're a supportive guide, not a strict examiner. Build confidence while teaching!
+"""
+
+# Everything before the per-request context, built once
+PROMPT_PREFIX = STATIC_SYSTEM_PROMPT + "\n\n"
+
+# Fixed pieces of the tutor context
+CONTEXT_HEADER = "You are a Socratic Tutor helping a student learn to code.\n\n"
+# Editor part of the context, filled with str.format_map
+_HEADER_TEMPLATE = (
+    CONTEXT_HEADER
+    + "Language: {language}\n"
+    + "Current File: {file_path} ({line_count} lines)\n\n"
+    + "Code:\n```{language}\n{code}\n```\n\n"
+    + "Cursor Position: Line {cursor_line}, Column {cursor_column}\n"
+)
+SEP = "=" * 50 + "\n"
+
+# Question types in priority order, found in one pass over the question
+_Q_CLASSIFIER = re.compile(
+    r"\b(?:(?P<correct>correct|right)|(?P<howwhy>how|why)"
+    r"|(?P<err>errors?|wrong)|(?P<loc>where))\b",
+    re.I
+)
+# "where" only counts as a location question together with one of these
+_LOCATION_RE = re.compile(r"\b(?:defined|functions?)\b", re.I)
+
+# Hint appended after the question for each type (first type found wins)
+QUESTION_HINTS = {
+    "correct": "\n[Student is asking if their code/output is correct - acknowledge if it is, then ask them to explain]\n",
+    "howwhy": "\n[Student wants to understand - explain the concept, then ask a follow-up question]\n",
+    "err": "\n[Student has an error - point it out gently, give a hint, suggest what to review]\n",
+    "loc": "\n[Student is asking about code location - use the RAG context to show where things are defined]\n",
+}
+
+# Lines of code kept above and below the cursor in the prompt
+CODE_WINDOW_RADIUS = 150
+
+def window_code(code: str, line: int, radius: int = CODE_WINDOW_RADIUS) -> str:
+    """
+    Cut code down to the lines around a (1-based) cursor line
+    Omitted lines are replaced by a marker so the model knows the file goes on
+    """
+    lines = code.split("\n")
+    if len(lines) <= 2 * radius + 1:
+        return code
+    
+    cursor = min(max(line, 1), len(lines)) - 1
+    start = max(0, cursor - radius)
+    end = min(len(lines), cursor + radius + 1)
+    
+    parts = []
+    if start > 0:
+        parts.append(f"... {start} lines above omitted ...")
+    parts.extend(lines[start:end])
+    if end < len(lines):
+        parts.append(f"... {len(lines) - end} lines below omitted ...")
+    return "\n".join(parts)
+
+ANTHROPIC_MESSAGES_URL = "https://api.anthropic.com/v1/messages"
+ANTHROPIC_VERSION = "2023-06-01"
+
+# Identical prompts answered from memory: entries kept and their lifetime (seconds)
+RESPONSE_CACHE_SIZE = 128
+RESPONSE_CACHE_TTL = 600.0
+
 class TutorAgent:
     """
     Shadow Tutor Agent - Provides Socratic guidance without giving direct answers
-    Supports both Ollama (local) and Gemini (cloud) models
+    Supports Ollama (local), Gemini and Anthropic (cloud) models
     """
     
     def __init__(self):
         self.ollama_url = f"{settings.OLLAMA_BASE_URL}/api/generate"
         self.ollama_model = settings.OLLAMA_MODEL
+        # One pooled client so LLM calls reuse keep-alive connections;
+        # bodies are sent pre-serialized with orjson
+        self._client = httpx.AsyncClient(
+            headers={"Content-Type": "application/json"},
+            timeout=30.0,
+            limits=httpx.Limits(
+                max_connections=100,
+                max_keepalive_connections=20
+            )
+        )
         
         # Configure Gemini if API key is provided
         if settings.GEMINI_API_KEY and settings.GEMINI_API_KEY != "your_gemini_api_key_here":
@@ -19,98 +129,92 @@ class TutorAgent:
             self.gemini_model = genai.GenerativeModel(settings.GEMINI_MODEL)
         else:
             self.gemini_model = None
+        # Cleared if the SDK turns out to have no usable async client
+        self._gemini_async = True
+        
+        # Answers by hash of (model, full prompt); near-duplicate questions
+        # are handled by the semantic cache in the tutor endpoint
+        self._response_cache = TTLCache(maxsize=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL)
+        
+        # Configure Anthropic if API key is provided
+        if settings.ANTHROPIC_API_KEY and settings.ANTHROPIC_API_KEY != "your_anthropic_api_key_here":
+            self.anthropic_model = settings.ANTHROPIC_MODEL
+        else:
+            self.anthropic_model = None
+    
+    async def aclose(self):
+        """Close the pooled HTTP client"""
+        await self._client.aclose()
         
     def build_context(self, editor_state: EditorState, user_question: str, rag_context: str = "") -> str:
         """
         Build context from editor state for the LLM
+        Ordered from least to most volatile so consecutive prompts share
+        the longest possible prefix
         """
-        context = f"""You are a Socratic Tutor helping a student learn to code.
-
-Current File: {editor_state.file_path}
-Language: {editor_state.language}
-Cursor Position: Line {editor_state.cursor_line}, Column {editor_state.cursor_column}
-
-Code:
-```{editor_state.language}
-{editor_state.full_code}
-```
-
-"""
+        parts = [_HEADER_TEMPLATE.format_map({
+            "language": editor_state.language,
+            "file_path": editor_state.file_path,
+            "line_count": editor_state.full_code.count("\n") + 1,
+            # Long files are cut to a window around the cursor; RAG context
+            # below covers definitions elsewhere
+            "code": window_code(editor_state.full_code, editor_state.cursor_line),
+            "cursor_line": editor_state.cursor_line,
+            "cursor_column": editor_state.cursor_column
+        })]
+        
         if editor_state.selected_text:
-            context += f"\nSelected Text:\n```\n{editor_state.selected_text}\n```\n"
+            parts += ["\nSelected Text:\n```\n", editor_state.selected_text, "\n```\n"]
             
         if editor_state.errors:
-            context += f"\n⚠️ Errors Detected:\n" + "\n".join(f"- {err}" for err in editor_state.errors) + "\n"
+            parts.append("\n⚠️ Errors Detected:\n")
+            parts += [f"- {err}\n" for err in editor_state.errors]
+        
+        # Add RAG context if available
+        if rag_context:
+            parts += ["\n", SEP, "📚 RELEVANT CODE FROM PROJECT:\n", SEP, rag_context, SEP]
         
         # Add execution results if available - PROMINENTLY
         last_execution = getattr(editor_state, 'last_execution', None)
         if last_execution:
-            context += f"\n{'='*50}\n"
-            context += f"📊 EXECUTION RESULTS (Student just ran this code):\n"
-            context += f"{'='*50}\n"
+            parts += ["\n", SEP, "📊 EXECUTION RESULTS (Student just ran this code):\n", SEP]
             if last_execution.get('output'):
-                context += f"✅ Output:\n{last_execution['output']}\n"
+                parts += ["✅ Output:\n", last_execution['output'], "\n"]
             if last_execution.get('error'):
-                context += f"❌ Error:\n{last_execution['error']}\n"
-            context += f"Executed at: {last_execution.get('timestamp', 'unknown')}\n"
-            context += f"{'='*50}\n"
-        
-        # Add RAG context if available
-        if rag_context:
-            context += f"\n{'='*50}\n"
-            context += f"📚 RELEVANT CODE FROM PROJECT:\n"
-            context += f"{'='*50}\n"
-            context += rag_context
-            context += f"{'='*50}\n"
+                parts += ["❌ Error:\n", last_execution['error'], "\n"]
+            parts += [f"Executed at: {last_execution.get('timestamp', 'unknown')}\n", SEP]
             
-        context += f"\n💬 Student Question: {user_question}\n"
+        parts += ["\n💬 Student Question: ", user_question, "\n"]
         
         # Add guidance based on question type
-        if "correct" in user_question.lower() or "right" in user_question.lower():
-            context += "\n[Student is asking if their code/output is correct - acknowledge if it is, then ask them to explain]\n"
-        elif "how" in user_question.lower() or "why" in user_question.lower():
-            context += "\n[Student wants to understand - explain the concept, then ask a follow-up question]\n"
-        elif "error" in user_question.lower() or "wrong" in user_question.lower():
-            context += "\n[Student has an error - point it out gently, give a hint, suggest what to review]\n"
-        elif "where" in user_question.lower() and ("defined" in user_question.lower() or "function" in user_question.lower()):
-            context += "\n[Student is asking about code location - use the RAG context to show where things are defined]\n"
+        parts.append(self._question_hint(user_question))
+        
+        return "".join(parts)
+    
+    def _question_hint(self, user_question: str) -> str:
+        """Pick the guidance hint for a question (empty if none applies)"""
+        found = {match.lastgroup for match in _Q_CLASSIFIER.finditer(user_question)}
+        if "loc" in found and not _LOCATION_RE.search(user_question):
+            found.discard("loc")
         
-        return context
+        for kind, hint in QUESTION_HINTS.items():
+            if kind in found:
+                return hint
+        return ""
+    
+    def build_dynamic_suffix(self, context: str) -> str:
+        """
+        Build the per-request part of the prompt (everything after STATIC_SYSTEM_PROMPT)
+        """
+        return f"{context}\n\nProvide a supportive, Socratic response:"
     
     def build_prompt(self, context: str) -> str:
         """
         Build the Socratic tutor prompt
+        The static system prompt always comes first, byte-for-byte identical,
+        so providers can serve it from their prompt cache
         """
-        system_prompt = """You are a supportive Socratic Tutor helping students learn to code.
-
-PERSONALITY:
-- Encouraging and positive
-- Acknowledge correct work first
-- Guide through questions, not lectures
-- Celebrate progress and effort
-
-RULES:
-1. If code is correct: Say "Yes, that's correct!" then ask them to explain WHY it works
-2. If code has errors: Point out the error gently, then guide them to fix it
-3. Use questions to deepen understanding, not to test
-4. Keep responses under 100 words
-5. Be warm and supportive
-
-RESPONSE PATTERN:
-✅ Correct code: "Great job! Your output is correct. Can you explain how [specific part] works?"
-❌ Error: "I see an issue on line X. What do you think [variable/function] should be doing here?"
-❓ Question: "Good question! Let's think about [concept]. What happens when...?"
-
-HELPFUL FEATURES:
-- Suggest reviewing specific concepts when stuck
-- Offer hints before full explanations
-- Connect to real-world examples
-- Encourage experimentation
-
-Remember: You're a supportive guide, not a strict examiner. Build confidence while teaching!
-"""
-        
-        return f"{system_prompt}\n\n{context}\n\nProvide a supportive, Socratic response:"
+        return PROMPT_PREFIX + self.build_dynamic_suffix(context)
     
     async def get_guidance(self, editor_state: EditorState, user_question: str, model_type: str = "ollama", rag_context: str = "") -> TutorResponse:
         """
@@ -119,57 +223,154 @@ Remember: You're a supportive guide, not a strict examiner. Build confidence whi
         Args:
             editor_state: Current editor state
             user_question: Student's question
-            model_type: "ollama" or "gemini"
+            model_type: "ollama", "gemini" or "anthropic"
             rag_context: Retrieved code context from RAG
         """
         try:
             context = self.build_context(editor_state, user_question, rag_context)
-            prompt = self.build_prompt(context)
             
-            if model_type == "gemini":
-                return await self._get_gemini_response(prompt)
-            else:
-                return await self._get_ollama_response(prompt)
+            key = self._response_cache_key(model_type, context)
+            cached = self._response_cache.get(key)
+            if cached:
+                return cached
+            
+            response = await self._dispatch(context, model_type)
+            self._response_cache.set(key, response)
+            return response
                     
         except Exception as e:
             print(f"Error calling LLM: {e}")
             return self._get_fallback_response(user_question)
     
+    async def stream_guidance(
+        self,
+        editor_state: EditorState,
+        user_question: str,
+        model_type: str = "ollama",
+        rag_context: str = ""
+    ) -> AsyncIterator[str]:
+        """
+        Yield the tutor's answer as it is generated
+        Ollama streams token by token; other models yield the whole answer once
+        
+        A failure before any text yields the fallback answer; a failure after
+        part of the answer was sent is re-raised, so the caller knows the text
+        is incomplete
+        """
+        sent_any = False
+        try:
+            context = self.build_context(editor_state, user_question, rag_context)
+            
+            key = self._response_cache_key(model_type, context)
+            cached = self._response_cache.get(key)
+            if cached:
+                sent_any = True
+                yield cached.response
+                return
+            
+            if model_type in ("gemini", "anthropic"):
+                response = await self._dispatch(context, model_type)
+                sent_any = True
+                yield response.response
+            else:
+                chunks = []
+                async for chunk in self._stream_ollama(self.build_prompt(context)):
+                    sent_any = True
+                    chunks.append(chunk)
+                    yield chunk
+                response = TutorResponse(response="".join(chunks), hints=[], related_concepts=[])
+            
+            self._response_cache.set(key, response)
+        
+        except Exception as e:
+            print(f"Error calling LLM: {e}")
+            if sent_any:
+                raise
+            yield self._get_fallback_response(user_question).response
+    
+    async def get_guidance_batch(
+        self,
+        requests: List[Tuple[EditorState, str, str, str]]
+    ) -> List[TutorResponse]:
+        """
+        Get guidance for several questions concurrently
+        
+        Args:
+            requests: (editor_state, user_question, model_type, rag_context) tuples
+            
+        Returns:
+            One response per request, in order; a failed call gets the fallback
+        
+        Ollama answers one prompt at a time unless the server is started
+        with OLLAMA_NUM_PARALLEL > 1
+        """
+        return await asyncio.gather(*[
+            self.get_guidance(editor_state, question, model_type, rag_context)
+            for editor_state, question, model_type, rag_context in requests
+        ])
+    
+    def _response_cache_key(self, model_type: str, context: str) -> str:
+        """Key for the exact-prompt response cache (the prompt is fully determined by the context)"""
+        return hashlib.blake2b(f"{model_type}\0{context}".encode(), digest_size=16).hexdigest()
+    
+    async def _dispatch(self, context: str, model_type: str) -> TutorResponse:
+        """Send the prompt for a context to the selected LLM"""
+        if model_type == "anthropic":
+            return await self._get_anthropic_response(self.build_dynamic_suffix(context))
+        if model_type == "gemini":
+            return await self._get_gemini_response(context)
+        return await self._get_ollama_response(self.build_prompt(context))
+    
     async def _get_ollama_response(self, prompt: str) -> TutorResponse:
         """
         Get response from Ollama (local LLM)
         """
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.post(
-                self.ollama_url,
-                json={
-                    "model": self.ollama_model,
-                    "prompt": prompt,
-                    "stream": False
-                }
-            )
+        chunks = [chunk async for chunk in self._stream_ollama(prompt)]
+        
+        return TutorResponse(
+            response="".join(chunks),
+            hints=[],
+            related_concepts=[]
+        )
+    
+    async def _stream_ollama(self, prompt: str) -> AsyncIterator[str]:
+        """
+        Stream response text from Ollama as it is generated (NDJSON lines)
+        """
+        async with self._client.stream(
+            "POST",
+            self.ollama_url,
+            content=orjson.dumps({
+                "model": self.ollama_model,
+                "prompt": prompt,
+                "stream": True,
+                # Keep the model (and its cached prompt prefix) loaded between turns
+                "keep_alive": settings.OLLAMA_KEEP_ALIVE
+            })
+        ) as response:
+            if response.status_code != 200:
+                raise Exception(f"Ollama returned status {response.status_code}")
             
-            if response.status_code == 200:
-                result = response.json()
-                ai_response = result.get("response", "")
+            async for line in response.aiter_lines():
+                if not line:
+                    continue
                 
-                return TutorResponse(
-                    response=ai_response,
-                    hints=[],
-                    related_concepts=[]
-                )
-            else:
-                raise Exception(f"Ollama returned status {response.status_code}")
+                chunk = orjson.loads(line)
+                if chunk.get("error"):
+                    raise Exception(f"Ollama error: {chunk['error']}")
+                if chunk.get("response"):
+                    yield chunk["response"]
+                if chunk.get("done"):
+                    break
     
-    async def _get_gemini_response(self, prompt: str) -> TutorResponse:
+    async def _get_gemini_response(self, context: str) -> TutorResponse:
         """
         Get response from Gemini (cloud LLM)
         """
         if not self.gemini_model:
             raise Exception("Gemini API key not configured")
         
-        # Gemini API is synchronous, but we'll wrap it for consistency
-        response = self.gemini_model.generate_content(prompt)
+        response = await self._gemini_generate(self.gemini_model, self.build_prompt(context))
         
         return TutorResponse(
             response=response.text,
@@ -177,6 +378,63 @@ Remember: You're a supportive guide, not a strict examiner. Build confidence whi
             related_concepts=[]
         )
     
+    async def _gemini_generate(self, model, prompt: str):
+        """
+        Call Gemini without blocking the event loop
+        Uses the SDK's async client; SDKs/transports without one (older
+        releases, transport="rest") run the sync call in a worker thread
+        """
+        if self._gemini_async:
+            try:
+                return await model.generate_content_async(prompt)
+            except (AttributeError, NotImplementedError) as e:
+                print(f"Gemini async client unavailable, using a thread: {e}")
+                self._gemini_async = False
+        
+        return await asyncio.to_thread(model.generate_content, prompt)
+    
+    async def _get_anthropic_response(self, user_content: str) -> TutorResponse:
+        """
+        Get response from Anthropic (cloud LLM)
+        The static system prompt goes in the system field, the context in
+        the user message
+        """
+        if not self.anthropic_model:
+            raise Exception("Anthropic API key not configured")
+        
+        response = await self._client.post(
+            ANTHROPIC_MESSAGES_URL,
+            headers={
+                "x-api-key": settings.ANTHROPIC_API_KEY,
+                "anthropic-version": ANTHROPIC_VERSION
+            },
+            content=orjson.dumps({
+                "model": self.anthropic_model,
+                "max_tokens": 1024,
+                "system": STATIC_SYSTEM_PROMPT,
+                "messages": [{"role": "user", "content": user_content}]
+            })
+        )
+        
+        if response.status_code == 200:
+            result = orjson.loads(response.content)
+            ai_response = "".join(
+                block.get("text", "") for block in result.get("content", [])
+                if block.get("type") == "text"
+            )
+            
+            return TutorResponse(
+                response=ai_response,
+                hints=[],
+                related_concepts=[]
+            )
+        else:
+            raise Exception(f"Anthropic returned status {response.status_code}")
+    
+    def is_fallback_response(self, response: TutorResponse) -> bool:
+        """Check whether a response is the canned 'LLM unavailable' answer"""
+        return response.response == self._get_fallback_response("").response
+    
     def _get_fallback_response(self, question: str) -> TutorResponse:
         """
         Provide a fallback response when LLM is unavailable
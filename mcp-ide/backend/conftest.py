@@ -0,0 +1,19 @@
+"""
+Shared pytest fixtures
+The embedding model is loaded once per test session (once per worker with pytest -n)
+"""
+import pytest
+
+@pytest.fixture(scope="session")
+def embedding_service():
+    """Embedding service with its model loaded (skips if sentence-transformers is missing)"""
+    pytest.importorskip("sentence_transformers")
+    from app.services.embedding_service import embedding_service
+
+    assert embedding_service.model is not None, "Embedding service model not loaded"
+    return embedding_service
+
+@pytest.fixture(scope="session")
+def st_model(embedding_service):
+    """The sentence-transformers model used by the embedding service"""
+    return embedding_service.model
@@ -1,12 +1,29 @@
+import asyncio
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from app.core.config import settings
 from app.api.api import api_router
+from app.services.file_service import file_service
+from app.services.rag_service import rag_service
+from app.services.supabase_service import supabase_service
+from app.services.tutor_agent import tutor_agent
+
+# Log records are queued by request handlers and written on a background thread
+log_queue = queue.SimpleQueue()
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+log_listener = QueueListener(log_queue, log_handler)
+logging.basicConfig(level=settings.LOG_LEVEL, handlers=[QueueHandler(log_queue)])
 
 app = FastAPI(
     title="MCP-IDE Backend",
     description="Context-Aware AI Coding Tutor API",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse
 )
 
 # CORS Configuration
@@ -21,6 +38,21 @@ app.add_middleware(
 # Include API routes
 app.include_router(api_router, prefix="/api/v1")
 
+@app.on_event("startup")
+async def startup():
+    log_listener.start()
+    await file_service.check_http2()
+    # Embeds files queued by editor saves
+    app.state.embedding_worker = asyncio.create_task(rag_service.run_embedding_worker())
+
+@app.on_event("shutdown")
+async def shutdown():
+    app.state.embedding_worker.cancel()
+    await file_service.aclose()
+    await supabase_service.aclose()
+    await tutor_agent.aclose()
+    log_listener.stop()
+
 @app.get("/")
 async def root():
     return {
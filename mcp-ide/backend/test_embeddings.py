@@ -1,86 +1,56 @@
 """
-Test script to verify sentence-transformers is working
-Run this to check if embeddings are being generated
+Tests to verify sentence-transformers is working
+Run with: pytest test_embeddings.py (or pytest -n auto with pytest-xdist)
 """
+import numpy as np
+import pytest
 
-print("Testing embedding service...")
-print("-" * 50)
-
-# Test 1: Check if sentence-transformers is installed
-print("\n1. Checking sentence-transformers installation...")
-try:
-    from sentence_transformers import SentenceTransformer
-    print("✅ sentence-transformers is installed")
-except ImportError as e:
-    print(f"❌ sentence-transformers NOT installed: {e}")
-    print("\nInstall with: pip install sentence-transformers")
-    exit(1)
-
-# Test 2: Load the model
-print("\n2. Loading embedding model (all-MiniLM-L6-v2)...")
-try:
-    model = SentenceTransformer('all-MiniLM-L6-v2')
-    print("✅ Model loaded successfully")
-except Exception as e:
-    print(f"❌ Failed to load model: {e}")
-    exit(1)
-
-# Test 3: Generate a test embedding
-print("\n3. Generating test embedding...")
-try:
-    test_code = """
+test_code = """
 function add(a, b) {
     return a + b;
 }
 """
-    embedding = model.encode(test_code, convert_to_numpy=True)
-    print(f"✅ Embedding generated successfully")
-    print(f"   Dimension: {len(embedding)}")
-    print(f"   First 5 values: {embedding[:5]}")
-except Exception as e:
-    print(f"❌ Failed to generate embedding: {e}")
-    exit(1)
+corpus = [test_code, "test code", "function test() { return 42; }"]
+
+def test_model_loaded(st_model):
+    """The embedding model loads through the embedding service"""
+    assert st_model is not None
 
-# Test 4: Test the embedding service
-print("\n4. Testing embedding service...")
-try:
-    from app.services.embedding_service import embedding_service
-    
-    if not embedding_service.model:
-        print("❌ Embedding service model not loaded")
-        exit(1)
-    
-    test_embedding = embedding_service.generate_embedding("test code")
-    if test_embedding:
-        print(f"✅ Embedding service working")
-        print(f"   Dimension: {len(test_embedding)}")
-    else:
-        print("❌ Embedding service returned None")
-        exit(1)
-except Exception as e:
-    print(f"❌ Embedding service error: {e}")
-    import traceback
-    traceback.print_exc()
-    exit(1)
+def test_batch_encode(st_model):
+    """The raw model embeds the whole corpus in one batch"""
+    embs = st_model.encode(corpus, batch_size=32, normalize_embeddings=True, convert_to_numpy=True)
+    assert embs.shape == (len(corpus), 384)
 
-# Test 5: Test code embedding
-print("\n5. Testing code embedding with context...")
-try:
-    code_embedding = embedding_service.generate_code_embedding(
-        code="function test() { return 42; }",
-        language="javascript",
-        file_path="test.js"
+def test_int8_close_to_fp32(st_model):
+    """The int8 model stays close to the full-precision one"""
+    from app.services.embedding_service import load_embedding_model, is_int8_model
+    if not is_int8_model(st_model):
+        pytest.skip("model is not int8 quantized (set EMBEDDING_INT8=1)")
+
+    embs = st_model.encode(corpus, batch_size=32, normalize_embeddings=True, convert_to_numpy=True)
+    reference = load_embedding_model(quantize=False).encode(
+        corpus, batch_size=32, normalize_embeddings=True, convert_to_numpy=True
     )
-    if code_embedding:
-        print(f"✅ Code embedding working")
-        print(f"   Dimension: {len(code_embedding)}")
-    else:
-        print("❌ Code embedding returned None")
-except Exception as e:
-    print(f"❌ Code embedding error: {e}")
-    import traceback
-    traceback.print_exc()
+    assert (embs * reference).sum(axis=1).min() > 0.99
+
+def test_embedding_service_batch(embedding_service):
+    """The service's batched path returns one 384-d vector per text"""
+    embeddings = embedding_service.generate_embeddings_batch(corpus)
+    assert len(embeddings) == len(corpus)
+    assert all(embedding and len(embedding) == 384 for embedding in embeddings)
 
-print("\n" + "=" * 50)
-print("✅ All tests passed! Embedding system is working.")
-print("=" * 50)
+@pytest.mark.parametrize("code,language,file_path", [
+    ("function test() { return 42; }", "javascript", "test.js"),
+    ("def test():\n    return 42\n", "python", "test.py"),
+    ("int main() { return 0; }", "cpp", "main.cpp"),
+])
+def test_code_embedding(embedding_service, code, language, file_path):
+    """Code embeddings with file context are unit vectors"""
+    embedding = embedding_service.generate_code_embedding(
+        code=code,
+        language=language,
+        file_path=file_path
+    )
+    assert embedding is not None
+    assert len(embedding) == 384
+    assert np.linalg.norm(embedding) == pytest.approx(1.0, abs=1e-3)
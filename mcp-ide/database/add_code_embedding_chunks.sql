@@ -0,0 +1,48 @@
+-- Chunked Code Embeddings
+-- Run this in your Supabase SQL Editor
+
+-- ============================================================================
+-- Store one embedding per chunk of a file instead of one per file
+-- Long files are split on function/class boundaries before embedding
+-- ============================================================================
+
+-- 1. Chunk position columns
+ALTER TABLE code_embeddings ADD COLUMN IF NOT EXISTS chunk_index INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE code_embeddings ADD COLUMN IF NOT EXISTS start_line INTEGER;
+ALTER TABLE code_embeddings ADD COLUMN IF NOT EXISTS end_line INTEGER;
+
+-- 2. One row per (file, chunk) - upsert target for bulk indexing
+ALTER TABLE code_embeddings DROP CONSTRAINT IF EXISTS code_embeddings_file_id_key;
+ALTER TABLE code_embeddings
+  ADD CONSTRAINT code_embeddings_file_chunk_key UNIQUE (file_id, chunk_index);
+
+-- 3. Search function now returns the matching chunk's line range
+DROP FUNCTION IF EXISTS match_code_embeddings(UUID, VECTOR(384), INT);
+CREATE OR REPLACE FUNCTION match_code_embeddings(p_project UUID, p_query VECTOR(384), p_k INT)
+RETURNS TABLE (
+  file_id UUID,
+  chunk_index INTEGER,
+  start_line INTEGER,
+  end_line INTEGER,
+  file_path TEXT,
+  language TEXT,
+  code_content TEXT,
+  similarity FLOAT
+)
+LANGUAGE sql STABLE
+AS $$
+  SELECT
+    ce.file_id,
+    ce.chunk_index,
+    ce.start_line,
+    ce.end_line,
+    ce.file_path,
+    ce.language,
+    ce.code_content,
+    1 - (ce.embedding <=> p_query) AS similarity
+  FROM code_embeddings ce
+  JOIN files f ON f.id = ce.file_id
+  WHERE f.project_id = p_project
+  ORDER BY ce.embedding <=> p_query
+  LIMIT p_k;
+$$;
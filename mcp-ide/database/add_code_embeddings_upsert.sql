@@ -0,0 +1,19 @@
+-- Allow Upserts on Code Embeddings
+-- Run this in your Supabase SQL Editor
+
+-- ============================================================================
+-- One embedding row per file, so PostgREST can upsert with on_conflict=file_id
+-- ============================================================================
+
+-- 1. Remove duplicate rows, keeping the most recently updated one per file
+DELETE FROM code_embeddings a
+USING code_embeddings b
+WHERE a.file_id = b.file_id
+  AND (a.updated_at, a.id) < (b.updated_at, b.id);
+
+-- 2. Add the unique constraint used as the upsert conflict target
+ALTER TABLE code_embeddings
+DROP CONSTRAINT IF EXISTS code_embeddings_file_id_key;
+
+ALTER TABLE code_embeddings
+ADD CONSTRAINT code_embeddings_file_id_key UNIQUE (file_id);
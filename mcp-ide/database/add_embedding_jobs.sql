@@ -0,0 +1,103 @@
+-- Background Embedding Queue
+-- Run this in your Supabase SQL Editor
+
+-- ============================================================================
+-- File saves enqueue a job; the backend worker claims and embeds them
+-- Called via PostgREST: POST /rest/v1/rpc/claim_embedding_jobs and
+-- POST /rest/v1/rpc/complete_embedding_jobs
+-- ============================================================================
+
+-- 1. Queue table (one row per file, so rapid saves coalesce)
+CREATE TABLE IF NOT EXISTS embedding_jobs (
+  file_id UUID PRIMARY KEY REFERENCES files(id) ON DELETE CASCADE,
+  enqueued_at TIMESTAMP WITH TIME ZONE DEFAULT TIMEZONE('utc'::text, NOW()),
+  claimed_at TIMESTAMP WITH TIME ZONE,
+  attempts INT NOT NULL DEFAULT 0
+);
+
+-- Queues created before jobs were leased
+ALTER TABLE embedding_jobs ADD COLUMN IF NOT EXISTS claimed_at TIMESTAMP WITH TIME ZONE;
+ALTER TABLE embedding_jobs ADD COLUMN IF NOT EXISTS attempts INT NOT NULL DEFAULT 0;
+
+CREATE INDEX IF NOT EXISTS embedding_jobs_enqueued_at_idx ON embedding_jobs(enqueued_at);
+
+ALTER TABLE embedding_jobs ENABLE ROW LEVEL SECURITY;
+DROP POLICY IF EXISTS "Anyone can manage embedding jobs" ON embedding_jobs;
+CREATE POLICY "Anyone can manage embedding jobs" ON embedding_jobs FOR ALL USING (true) WITH CHECK (true);
+
+-- 2. Enqueue on content changes
+CREATE OR REPLACE FUNCTION enqueue_embedding_job()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+BEGIN
+  IF NOT NEW.is_folder THEN
+    INSERT INTO embedding_jobs (file_id)
+    VALUES (NEW.id)
+    ON CONFLICT (file_id) DO UPDATE
+      SET enqueued_at = TIMEZONE('utc'::text, NOW()), claimed_at = NULL, attempts = 0;
+  END IF;
+  RETURN NEW;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS files_enqueue_embedding ON files;
+CREATE TRIGGER files_enqueue_embedding
+  AFTER INSERT OR UPDATE OF content ON files
+  FOR EACH ROW EXECUTE FUNCTION enqueue_embedding_job();
+
+-- 3. Claim jobs for the worker (leases rows; expired leases are claimed again)
+DROP FUNCTION IF EXISTS claim_embedding_jobs(INT);
+CREATE OR REPLACE FUNCTION claim_embedding_jobs(
+  p_limit INT DEFAULT 16,
+  p_lease_seconds INT DEFAULT 300,
+  p_max_attempts INT DEFAULT 5
+)
+RETURNS TABLE (
+  id UUID,
+  path TEXT,
+  language TEXT,
+  content TEXT,
+  embedded_hash TEXT
+)
+LANGUAGE sql VOLATILE
+AS $$
+  WITH claimed AS (
+    UPDATE embedding_jobs j
+    SET claimed_at = NOW(), attempts = j.attempts + 1
+    WHERE j.file_id IN (
+      SELECT file_id FROM embedding_jobs
+      WHERE attempts < p_max_attempts
+        AND (claimed_at IS NULL OR claimed_at < NOW() - make_interval(secs => p_lease_seconds))
+      ORDER BY enqueued_at
+      LIMIT p_limit
+      FOR UPDATE SKIP LOCKED
+    )
+    RETURNING j.file_id
+  )
+  SELECT
+    f.id,
+    f.path,
+    f.language,
+    COALESCE(f.content, ''),
+    (SELECT ce.content_hash FROM code_embeddings ce WHERE ce.file_id = f.id LIMIT 1)
+  FROM claimed c
+  JOIN files f ON f.id = c.file_id;
+$$;
+
+-- 4. Finish claimed jobs: delete the done ones, release the failed ones for a retry
+CREATE OR REPLACE FUNCTION complete_embedding_jobs(
+  p_done UUID[] DEFAULT '{}',
+  p_failed UUID[] DEFAULT '{}'
+)
+RETURNS VOID
+LANGUAGE sql VOLATILE
+AS $$
+  -- Jobs re-enqueued since the claim have claimed_at reset and are kept
+  DELETE FROM embedding_jobs
+  WHERE file_id = ANY(p_done) AND claimed_at IS NOT NULL;
+
+  UPDATE embedding_jobs
+  SET claimed_at = NULL
+  WHERE file_id = ANY(p_failed) AND claimed_at IS NOT NULL;
+$$;
@@ -0,0 +1,45 @@
+-- Half-Precision Code Embeddings
+-- Run this in your Supabase SQL Editor (requires pgvector 0.7+)
+
+-- ============================================================================
+-- Store code embeddings as halfvec (fp16): half the storage and index size,
+-- and shorter vectors on every read, at no practical cost to cosine ranking
+-- ============================================================================
+
+-- 1. Convert the column (the HNSW index must be rebuilt for the new type)
+DROP INDEX IF EXISTS code_embeddings_embedding_hnsw_idx;
+ALTER TABLE code_embeddings
+  ALTER COLUMN embedding TYPE HALFVEC(384) USING embedding::HALFVEC(384);
+
+CREATE INDEX IF NOT EXISTS code_embeddings_embedding_hnsw_idx
+  ON code_embeddings USING hnsw (embedding halfvec_cosine_ops);
+
+-- 2. Search function compares in halfvec space so the index is used
+CREATE OR REPLACE FUNCTION match_code_embeddings(p_project UUID, p_query VECTOR(384), p_k INT)
+RETURNS TABLE (
+  file_id UUID,
+  chunk_index INTEGER,
+  start_line INTEGER,
+  end_line INTEGER,
+  file_path TEXT,
+  language TEXT,
+  code_content TEXT,
+  similarity FLOAT
+)
+LANGUAGE sql STABLE
+AS $$
+  SELECT
+    ce.file_id,
+    ce.chunk_index,
+    ce.start_line,
+    ce.end_line,
+    ce.file_path,
+    ce.language,
+    ce.code_content,
+    1 - (ce.embedding <=> p_query::HALFVEC(384)) AS similarity
+  FROM code_embeddings ce
+  JOIN files f ON f.id = ce.file_id
+  WHERE f.project_id = p_project
+  ORDER BY ce.embedding <=> p_query::HALFVEC(384)
+  LIMIT p_k;
+$$;
@@ -0,0 +1,36 @@
+-- Server-Side Code Search
+-- Run this in your Supabase SQL Editor
+
+-- ============================================================================
+-- Top-k cosine search over a project's code embeddings
+-- Called via PostgREST: POST /rest/v1/rpc/match_code_embeddings
+-- ============================================================================
+
+-- 1. HNSW index for cosine distance (replaces the ivfflat index)
+DROP INDEX IF EXISTS code_embeddings_embedding_idx;
+CREATE INDEX IF NOT EXISTS code_embeddings_embedding_hnsw_idx
+  ON code_embeddings USING hnsw (embedding vector_cosine_ops);
+
+-- 2. Search function
+CREATE OR REPLACE FUNCTION match_code_embeddings(p_project UUID, p_query VECTOR(384), p_k INT)
+RETURNS TABLE (
+  file_id UUID,
+  file_path TEXT,
+  language TEXT,
+  code_content TEXT,
+  similarity FLOAT
+)
+LANGUAGE sql STABLE
+AS $$
+  SELECT
+    ce.file_id,
+    ce.file_path,
+    ce.language,
+    ce.code_content,
+    1 - (ce.embedding <=> p_query) AS similarity
+  FROM code_embeddings ce
+  JOIN files f ON f.id = ce.file_id
+  WHERE f.project_id = p_project
+  ORDER BY ce.embedding <=> p_query
+  LIMIT p_k;
+$$;
@@ -0,0 +1,65 @@
+-- Semantic Query Cache
+-- Run this in your Supabase SQL Editor
+
+-- ============================================================================
+-- Caches tutor answers by question embedding so near-duplicate questions
+-- asked against the same workspace skip retrieval and the LLM call
+-- Called via PostgREST: POST /rest/v1/rpc/match_cached_query and
+-- POST /rest/v1/rpc/put_cached_query
+-- ============================================================================
+
+-- 1. Cache table (entries expire after 24 hours)
+CREATE TABLE IF NOT EXISTS semantic_query_cache (
+  id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+  workspace_id TEXT NOT NULL,
+  query_embedding VECTOR(384) NOT NULL,
+  response JSONB NOT NULL,
+  created_at TIMESTAMP WITH TIME ZONE DEFAULT TIMEZONE('utc'::text, NOW()),
+  expires_at TIMESTAMP WITH TIME ZONE DEFAULT TIMEZONE('utc'::text, NOW()) + INTERVAL '24 hours'
+);
+
+-- Lookups scan one workspace exactly (a handful of rows per editor state).
+-- No HNSW index: filtered by workspace it only sees ef_search candidates
+-- and misses entries once other workspaces fill the table
+DROP INDEX IF EXISTS semantic_query_cache_embedding_idx;
+CREATE INDEX IF NOT EXISTS semantic_query_cache_workspace_idx ON semantic_query_cache(workspace_id);
+CREATE INDEX IF NOT EXISTS semantic_query_cache_expires_at_idx ON semantic_query_cache(expires_at);
+
+ALTER TABLE semantic_query_cache ENABLE ROW LEVEL SECURITY;
+DROP POLICY IF EXISTS "Anyone can manage semantic query cache" ON semantic_query_cache;
+CREATE POLICY "Anyone can manage semantic query cache" ON semantic_query_cache FOR ALL USING (true) WITH CHECK (true);
+
+-- 2. Closest unexpired entry in the workspace above the similarity threshold
+--    (exact scan of the workspace's entries)
+CREATE OR REPLACE FUNCTION match_cached_query(p_query VECTOR(384), p_threshold FLOAT, p_workspace TEXT)
+RETURNS TABLE (
+  response JSONB,
+  similarity FLOAT
+)
+LANGUAGE sql STABLE
+AS $$
+  WITH candidates AS MATERIALIZED (
+    SELECT c.response, c.query_embedding
+    FROM semantic_query_cache c
+    WHERE c.workspace_id = p_workspace
+      AND c.expires_at > NOW()
+  )
+  SELECT
+    response,
+    1 - (query_embedding <=> p_query) AS similarity
+  FROM candidates
+  WHERE 1 - (query_embedding <=> p_query) >= p_threshold
+  ORDER BY query_embedding <=> p_query
+  LIMIT 1;
+$$;
+
+-- 3. Store an answer, purging expired entries first
+CREATE OR REPLACE FUNCTION put_cached_query(p_workspace TEXT, p_query VECTOR(384), p_response JSONB)
+RETURNS VOID
+LANGUAGE sql
+AS $$
+  DELETE FROM semantic_query_cache WHERE expires_at <= NOW();
+  
+  INSERT INTO semantic_query_cache (workspace_id, query_embedding, response)
+  VALUES (p_workspace, p_query, p_response);
+$$;
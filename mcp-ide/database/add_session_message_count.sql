@@ -0,0 +1,17 @@
+-- Session Message Count Increment
+-- Run this in your Supabase SQL Editor
+
+-- ============================================================================
+-- Adds saved messages to a session's count on the server, so several
+-- backend workers (or a restarted one) never overwrite each other's counts
+-- Called via PostgREST: POST /rest/v1/rpc/add_session_messages
+-- ============================================================================
+
+CREATE OR REPLACE FUNCTION add_session_messages(p_session UUID, p_count INT)
+RETURNS VOID
+LANGUAGE sql
+AS $$
+  UPDATE tutor_sessions
+  SET message_count = COALESCE(message_count, 0) + p_count
+  WHERE id = p_session;
+$$;
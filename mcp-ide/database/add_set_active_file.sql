@@ -0,0 +1,16 @@
+-- Atomic Active-File Switch
+-- Run this in your Supabase SQL Editor
+
+-- ============================================================================
+-- Activates one file and deactivates the rest of the project in one statement
+-- Called via PostgREST: POST /rest/v1/rpc/set_active_file
+-- ============================================================================
+
+CREATE OR REPLACE FUNCTION set_active_file(p_project UUID, p_file UUID)
+RETURNS VOID
+LANGUAGE sql
+AS $$
+  UPDATE files
+  SET is_active = (id = p_file)
+  WHERE project_id = p_project;
+$$;
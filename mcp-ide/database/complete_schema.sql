@@ -127,19 +127,23 @@ CREATE INDEX IF NOT EXISTS code_history_created_at_idx ON code_history(created_a
 CREATE TABLE IF NOT EXISTS code_embeddings (
   id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
   file_id UUID REFERENCES files(id) ON DELETE CASCADE,
+  chunk_index INTEGER NOT NULL DEFAULT 0,  -- Position of the chunk within the file
+  start_line INTEGER,  -- First line of the chunk (1-based)
+  end_line INTEGER,  -- Last line of the chunk (inclusive)
   file_path TEXT NOT NULL,
   language TEXT NOT NULL,
   code_content TEXT,  -- The actual code content
-  embedding VECTOR(384),  -- 384 dimensions for all-MiniLM-L6-v2
+  embedding HALFVEC(384),  -- 384 dimensions for all-MiniLM-L6-v2, stored as fp16
   content_hash TEXT,  -- SHA256 hash to detect changes
   created_at TIMESTAMP WITH TIME ZONE DEFAULT TIMEZONE('utc'::text, NOW()),
-  updated_at TIMESTAMP WITH TIME ZONE DEFAULT TIMEZONE('utc'::text, NOW())
+  updated_at TIMESTAMP WITH TIME ZONE DEFAULT TIMEZONE('utc'::text, NOW()),
+  CONSTRAINT code_embeddings_file_chunk_key UNIQUE (file_id, chunk_index)
 );
 
 CREATE INDEX IF NOT EXISTS code_embeddings_file_id_idx ON code_embeddings(file_id);
 CREATE INDEX IF NOT EXISTS code_embeddings_content_hash_idx ON code_embeddings(content_hash);
-CREATE INDEX IF NOT EXISTS code_embeddings_embedding_idx 
-  ON code_embeddings USING ivfflat (embedding vector_cosine_ops) WITH (lists = 100);
+CREATE INDEX IF NOT EXISTS code_embeddings_embedding_hnsw_idx 
+  ON code_embeddings USING hnsw (embedding halfvec_cosine_ops);
 CREATE INDEX IF NOT EXISTS code_embeddings_file_path_idx ON code_embeddings(file_path);
 CREATE INDEX IF NOT EXISTS code_embeddings_language_idx ON code_embeddings(language);
 
@@ -207,6 +211,41 @@ CREATE INDEX IF NOT EXISTS common_errors_embedding_idx
   ON common_errors USING ivfflat (embedding vector_cosine_ops) WITH (lists = 100);
 CREATE INDEX IF NOT EXISTS common_errors_language_idx ON common_errors(language);
 
+-- ============================================================================
+-- 11. EMBEDDING JOBS TABLE (background embedding queue)
+-- ============================================================================
+CREATE TABLE IF NOT EXISTS embedding_jobs (
+  file_id UUID PRIMARY KEY REFERENCES files(id) ON DELETE CASCADE,
+  enqueued_at TIMESTAMP WITH TIME ZONE DEFAULT TIMEZONE('utc'::text, NOW()),
+  claimed_at TIMESTAMP WITH TIME ZONE,
+  attempts INT NOT NULL DEFAULT 0
+);
+
+-- Queues created before jobs were leased
+ALTER TABLE embedding_jobs ADD COLUMN IF NOT EXISTS claimed_at TIMESTAMP WITH TIME ZONE;
+ALTER TABLE embedding_jobs ADD COLUMN IF NOT EXISTS attempts INT NOT NULL DEFAULT 0;
+
+CREATE INDEX IF NOT EXISTS embedding_jobs_enqueued_at_idx ON embedding_jobs(enqueued_at);
+
+-- ============================================================================
+-- 12. SEMANTIC QUERY CACHE TABLE (tutor answers by question embedding)
+-- ============================================================================
+CREATE TABLE IF NOT EXISTS semantic_query_cache (
+  id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+  workspace_id TEXT NOT NULL,
+  query_embedding VECTOR(384) NOT NULL,
+  response JSONB NOT NULL,
+  created_at TIMESTAMP WITH TIME ZONE DEFAULT TIMEZONE('utc'::text, NOW()),
+  expires_at TIMESTAMP WITH TIME ZONE DEFAULT TIMEZONE('utc'::text, NOW()) + INTERVAL '24 hours'
+);
+
+-- Lookups scan one workspace exactly (a handful of rows per editor state).
+-- No HNSW index: filtered by workspace it only sees ef_search candidates
+-- and misses entries once other workspaces fill the table
+DROP INDEX IF EXISTS semantic_query_cache_embedding_idx;
+CREATE INDEX IF NOT EXISTS semantic_query_cache_workspace_idx ON semantic_query_cache(workspace_id);
+CREATE INDEX IF NOT EXISTS semantic_query_cache_expires_at_idx ON semantic_query_cache(expires_at);
+
 -- ============================================================================
 -- HELPER FUNCTIONS
 -- ============================================================================
@@ -297,6 +336,167 @@ BEGIN
 END;
 $$;
 
+-- Activate one file and deactivate the rest of its project atomically
+CREATE OR REPLACE FUNCTION set_active_file(p_project UUID, p_file UUID)
+RETURNS VOID
+LANGUAGE sql
+AS $$
+  UPDATE files
+  SET is_active = (id = p_file)
+  WHERE project_id = p_project;
+$$;
+
+-- Add saved messages to a session's count (server-side, safe across workers)
+CREATE OR REPLACE FUNCTION add_session_messages(p_session UUID, p_count INT)
+RETURNS VOID
+LANGUAGE sql
+AS $$
+  UPDATE tutor_sessions
+  SET message_count = COALESCE(message_count, 0) + p_count
+  WHERE id = p_session;
+$$;
+
+-- Top-k cosine search over a project's code embeddings
+CREATE OR REPLACE FUNCTION match_code_embeddings(p_project UUID, p_query VECTOR(384), p_k INT)
+RETURNS TABLE (
+  file_id UUID,
+  chunk_index INTEGER,
+  start_line INTEGER,
+  end_line INTEGER,
+  file_path TEXT,
+  language TEXT,
+  code_content TEXT,
+  similarity FLOAT
+)
+LANGUAGE sql STABLE
+AS $$
+  SELECT
+    ce.file_id,
+    ce.chunk_index,
+    ce.start_line,
+    ce.end_line,
+    ce.file_path,
+    ce.language,
+    ce.code_content,
+    1 - (ce.embedding <=> p_query::HALFVEC(384)) AS similarity
+  FROM code_embeddings ce
+  JOIN files f ON f.id = ce.file_id
+  WHERE f.project_id = p_project
+  ORDER BY ce.embedding <=> p_query::HALFVEC(384)
+  LIMIT p_k;
+$$;
+
+-- Enqueue embedding jobs on content changes
+CREATE OR REPLACE FUNCTION enqueue_embedding_job()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+BEGIN
+  IF NOT NEW.is_folder THEN
+    INSERT INTO embedding_jobs (file_id)
+    VALUES (NEW.id)
+    ON CONFLICT (file_id) DO UPDATE
+      SET enqueued_at = TIMEZONE('utc'::text, NOW()), claimed_at = NULL, attempts = 0;
+  END IF;
+  RETURN NEW;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS files_enqueue_embedding ON files;
+CREATE TRIGGER files_enqueue_embedding
+  AFTER INSERT OR UPDATE OF content ON files
+  FOR EACH ROW EXECUTE FUNCTION enqueue_embedding_job();
+
+-- Claim embedding jobs for the worker (leases rows; expired leases are claimed again)
+DROP FUNCTION IF EXISTS claim_embedding_jobs(INT);
+CREATE OR REPLACE FUNCTION claim_embedding_jobs(
+  p_limit INT DEFAULT 16,
+  p_lease_seconds INT DEFAULT 300,
+  p_max_attempts INT DEFAULT 5
+)
+RETURNS TABLE (
+  id UUID,
+  path TEXT,
+  language TEXT,
+  content TEXT,
+  embedded_hash TEXT
+)
+LANGUAGE sql VOLATILE
+AS $$
+  WITH claimed AS (
+    UPDATE embedding_jobs j
+    SET claimed_at = NOW(), attempts = j.attempts + 1
+    WHERE j.file_id IN (
+      SELECT file_id FROM embedding_jobs
+      WHERE attempts < p_max_attempts
+        AND (claimed_at IS NULL OR claimed_at < NOW() - make_interval(secs => p_lease_seconds))
+      ORDER BY enqueued_at
+      LIMIT p_limit
+      FOR UPDATE SKIP LOCKED
+    )
+    RETURNING j.file_id
+  )
+  SELECT
+    f.id,
+    f.path,
+    f.language,
+    COALESCE(f.content, ''),
+    (SELECT ce.content_hash FROM code_embeddings ce WHERE ce.file_id = f.id LIMIT 1)
+  FROM claimed c
+  JOIN files f ON f.id = c.file_id;
+$$;
+
+-- Finish claimed embedding jobs: delete the done ones, release the failed ones for a retry
+CREATE OR REPLACE FUNCTION complete_embedding_jobs(
+  p_done UUID[] DEFAULT '{}',
+  p_failed UUID[] DEFAULT '{}'
+)
+RETURNS VOID
+LANGUAGE sql VOLATILE
+AS $$
+  -- Jobs re-enqueued since the claim have claimed_at reset and are kept
+  DELETE FROM embedding_jobs
+  WHERE file_id = ANY(p_done) AND claimed_at IS NOT NULL;
+
+  UPDATE embedding_jobs
+  SET claimed_at = NULL
+  WHERE file_id = ANY(p_failed) AND claimed_at IS NOT NULL;
+$$;
+
+-- Semantic cache lookup: closest unexpired entry in the workspace above the similarity threshold
+CREATE OR REPLACE FUNCTION match_cached_query(p_query VECTOR(384), p_threshold FLOAT, p_workspace TEXT)
+RETURNS TABLE (
+  response JSONB,
+  similarity FLOAT
+)
+LANGUAGE sql STABLE
+AS $$
+  WITH candidates AS MATERIALIZED (
+    SELECT c.response, c.query_embedding
+    FROM semantic_query_cache c
+    WHERE c.workspace_id = p_workspace
+      AND c.expires_at > NOW()
+  )
+  SELECT
+    response,
+    1 - (query_embedding <=> p_query) AS similarity
+  FROM candidates
+  WHERE 1 - (query_embedding <=> p_query) >= p_threshold
+  ORDER BY query_embedding <=> p_query
+  LIMIT 1;
+$$;
+
+-- Semantic cache insert: purge expired entries, then store the answer
+CREATE OR REPLACE FUNCTION put_cached_query(p_workspace TEXT, p_query VECTOR(384), p_response JSONB)
+RETURNS VOID
+LANGUAGE sql
+AS $$
+  DELETE FROM semantic_query_cache WHERE expires_at <= NOW();
+  
+  INSERT INTO semantic_query_cache (workspace_id, query_embedding, response)
+  VALUES (p_workspace, p_query, p_response);
+$$;
+
 -- ============================================================================
 -- ROW LEVEL SECURITY (RLS) - Allow anonymous for now
 -- ============================================================================
@@ -308,6 +508,8 @@ ALTER TABLE tutor_sessions ENABLE ROW LEVEL SECURITY;
 ALTER TABLE tutor_messages ENABLE ROW LEVEL SECURITY;
 ALTER TABLE code_history ENABLE ROW LEVEL SECURITY;
 ALTER TABLE code_embeddings ENABLE ROW LEVEL SECURITY;
+ALTER TABLE embedding_jobs ENABLE ROW LEVEL SECURITY;
+ALTER TABLE semantic_query_cache ENABLE ROW LEVEL SECURITY;
 
 -- Allow all operations for anonymous users (will add proper auth later)
 DROP POLICY IF EXISTS "Anyone can manage projects" ON projects;
@@ -343,6 +545,12 @@ CREATE POLICY "Anyone can view code history" ON code_history FOR SELECT USING (t
 DROP POLICY IF EXISTS "Anyone can manage code embeddings" ON code_embeddings;
 CREATE POLICY "Anyone can manage code embeddings" ON code_embeddings FOR ALL USING (true) WITH CHECK (true);
 
+DROP POLICY IF EXISTS "Anyone can manage embedding jobs" ON embedding_jobs;
+CREATE POLICY "Anyone can manage embedding jobs" ON embedding_jobs FOR ALL USING (true) WITH CHECK (true);
+
+DROP POLICY IF EXISTS "Anyone can manage semantic query cache" ON semantic_query_cache;
+CREATE POLICY "Anyone can manage semantic query cache" ON semantic_query_cache FOR ALL USING (true) WITH CHECK (true);
+
 -- Public read for documentation
 DROP POLICY IF EXISTS "Anyone can view documentation embeddings" ON doc_embeddings;
 CREATE POLICY "Anyone can view documentation embeddings" ON doc_embeddings FOR SELECT USING (true);